@@ -1,4 +1,5 @@
 import pandas as pd
+import TimestampParser as tparser
 rowswithName=1
 entity="BTRF MEK Unit"
 file="C:\\Users\\m2bre\\Documents\\Projects\\XOM R&E\\BTRF MEK FILTERS\\LUMDCPSDATA2015.csv"
@@ -16,6 +17,6 @@ for col in df.columns:
 colnames[0]="timestamp"
 # now read the values
 df=pd.read_csv(file,header=None,skiprows=rowswithName,names=colnames,low_memory=False)
-df["timestamp"]=df["timestamp"].str.replace("-06:00","").str.replace("-05:00","")
+df["timestamp"]=tparser.stripoffsets(df["timestamp"])
 df["entity"]=[entity]*df.shape[0]
 df.to_csv(file.replace(".csv","_falkonry.csv"),index=False)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import pandas as pd
+import TimestampParser as tparser
 import  BatchGenerators.BatchGenerator as bgen
 boolAddBatch=True
 rowWithTagName=2
@@ -15,6 +16,6 @@ for col in df.columns:
     colnames.append(colname)
 # now read the values
 df=pd.read_csv(file,header=None,skiprows=headerRows,names=colnames,low_memory=False)
-df["timestamp"]=df["timestamp"].str.replace("-06:00","").str.replace("-05:00","")
+df["timestamp"]=tparser.stripoffsets(df["timestamp"])
 df["entity"]=[entity]*df.shape[0]
 df.to_csv(file.replace(".csv","_falkonry.csv"),index=False)
\ No newline at end of file
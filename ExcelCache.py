@@ -0,0 +1,77 @@
+import os
+import hashlib
+import pickle
+import pandas as pd
+
+# parsed .xlsx workbooks saved as pickled frames so later runs skip read_excel
+# an entry is keyed by the workbook's path, size, mtime and content hash (and the pandas version)
+# the least recently used entries are removed once the cache directory is over its size cap
+defaultdir=os.path.join(os.path.expanduser('~'),'.cache','TimeseriesGapFiller')
+defaultcapmb=500
+suffix='.pkl'
+
+# sha1 of the content of path
+def contenthash(path,block=1048576):
+    h=hashlib.sha1()
+    with open(path,'rb') as fin:
+        for data in iter(lambda:fin.read(block),b''):
+            h.update(data)
+    return h.hexdigest()
+
+# name of the cache entry for the workbook at path
+def cachekey(path):
+    st=os.stat(path)
+    key="%s|%s|%s|%s|%s" % (os.path.abspath(path),st.st_size,st.st_mtime_ns,contenthash(path),pd.__version__)
+    return hashlib.sha1(key.encode('UTF-8')).hexdigest()
+
+# removes least recently used entries until the entries in cachedir total at most capbytes
+# keep is an entry that is never removed (the one just used)
+def evict(cachedir,capbytes,keep=None):
+    entries=[]
+    for name in os.listdir(cachedir):
+        if(not name.endswith(suffix)):
+            continue
+        try:
+            st=os.stat(os.path.join(cachedir,name))
+        except OSError:
+            continue
+        entries.append((st.st_mtime,st.st_size,name))
+    total=sum(e[1] for e in entries)
+    for mtime,size,name in sorted(entries):
+        if(total<=capbytes):
+            break
+        if(name==keep):
+            continue
+        try:
+            os.remove(os.path.join(cachedir,name))
+            print("Removed cache entry %s (%s bytes)" % (name,size))
+        except OSError:
+            pass
+        total-=size
+
+# frame of the first sheet of the workbook at path, from cachedir when it was parsed before
+def readexcel(path,cachedir=defaultdir,capmb=defaultcapmb):
+    os.makedirs(cachedir,exist_ok=True)
+    name=cachekey(path)+suffix
+    entry=os.path.join(cachedir,name)
+    if(os.path.exists(entry)):
+        try:
+            df=pd.read_pickle(entry)
+            # last use is the mtime of the entry
+            os.utime(entry)
+            print("Loaded %s from cache %s" % (path,entry))
+            return df
+        except (OSError,EOFError,pickle.UnpicklingError,AttributeError,ImportError,TypeError):
+            print("Cache entry %s could not be read, parsing %s again" % (entry,path))
+    df=pd.read_excel(path)
+    # written to a temporary name first so a partial entry is never read
+    tmp="%s.%s.tmp" % (entry,os.getpid())
+    try:
+        df.to_pickle(tmp)
+        os.replace(tmp,entry)
+        evict(cachedir,capmb*1048576,name)
+    except OSError:
+        print("Could not save %s to cache %s" % (path,cachedir))
+        if(os.path.exists(tmp)):
+            os.remove(tmp)
+    return df
@@ -1,17 +1,28 @@
-from falkonryclient import client as Falkonry
-from falkonryclient import schemas as Schemas
 import sys, io, os
 import glob, shutil
 import argparse
 import time
 import json
 import datetime
+import concurrent.futures
+import zlib
+import sqlite3
+import hashlib
+import itertools
+import random
+import threading
 
 #
 # Treat this as a constant
 #
 WAIT_TIME_LIMIT = 1800
 SIZE_LIMIT = 50 * 1024 * 1024
+POLL_MIN = 0.5  # In seconds, shortest wait before a job is polled
+POLL_MAX = 60  # In seconds, longest wait between two polls of a job
+POLL_RATE = 2  # Status checks per second over all jobs
+RETRY_PAUSE = 5  # In seconds, wait before a chunk in ERROR is sent again, doubled on each retry
+ERROR_LIMIT = 3
+COMPRESS_BLOCK = 1024 * 1024
 
 
 #
@@ -31,119 +42,843 @@ def err_msg(msg):
 
 
 #
-# Method to upload a chunk consisting of multiple files
+# State of a chunk while it is uploaded
+# files holds the pieces (name, start, end, pieces of the file, size, mtime) the chunk is made of
+# A streaming chunk is sent with the streaming ingestion options
 #
-def upload_chunk(chunk, ds_id, falkonry):
-    start_time = int(time.time())
-    pause = 5  # In seconds
-    processed = 0
-    error_count = 0
-    error_limit = 3
-    status = False
+class ChunkUpload:
+    def __init__(self, files, data, size, level=0, streaming=False):
+        self.files = files
+        self.data = data
+        self.size = size
+        self.level = level
+        self.opts = {'streaming': streaming, 'hasMoreData': streaming}
+        self.cid = None  # id in the journal
+        self.packed = None  # future of the compressed data when compressing
+        self.job = None  # future of add_input_data
+        self.job_id = None
+        self.start_time = int(time.time())
+        self.accepted_at = None  # when the job of the current attempt was created
+        self.pending_at = None  # when the job of the current attempt was last seen PENDING
+        self.deadline = None  # the current attempt is skipped when still pending after this
+        self.poll_delay = POLL_MIN
+        self.next_poll = 0
+        self.resubmit_at = 0  # when a chunk in ERROR is sent again
+        self.send_time = 0.0  # seconds spent sending, over all attempts
+        self.read_time = 0.0  # seconds spent assembling the chunk from its files
+        self.pending_time = 0.0  # seconds the jobs were PENDING on the server, over all attempts
+        self.sent_size = 0  # bytes sent by the last attempt, compressed when compressing
+        self.error_count = 0
+        self.status = None  # True or False once finished
+
+
+#
+# Decides when the jobs are polled
+# The time a job takes is learnt as a fixed overhead plus seconds per MB, fitted over the jobs that succeeded.
+# A job is first polled shortly before it is expected to finish, then the wait doubles (with jitter) each time
+# it is still pending. Status checks of all jobs share a token bucket of rate checks per second, a rate of 0
+# does not limit them.
+#
+class PollScheduler:
+    def __init__(self, rate=POLL_RATE, alpha=0.3):
+        self.rate = rate
+        self.alpha = alpha
+        self.fit = [0.0] * 5  # decayed sums of 1, MB, seconds, MB * MB and MB * seconds of the jobs learnt
+        self.tokens = max(rate, 1)
+        self.refilled = time.time()
+        self.polls = 0
+        self.poll_time = 0.0
+
+    def jitter(self, delay):
+        return delay * random.uniform(0.75, 1.25)
+
+    def clamp(self, delay):
+        return min(max(delay, POLL_MIN), POLL_MAX)
+
+    #
+    # Seconds a job of mb MB is expected to take, None before any job is learnt
+    #
+    def expected(self, mb):
+        (n, sx, sy, sxx, sxy) = self.fit
+        if (n <= 0):
+            return None
+        mx = sx / n
+        my = sy / n
+        var = sxx / n - mx * mx
+        per_mb = max((sxy / n - mx * my) / var, 0) if var > 1e-9 else 0
+        overhead = max(my - per_mb * mx, 0)
+        return overhead + per_mb * mb
+
+    def learn(self, mb, seconds):
+        self.fit = [(1 - self.alpha) * f + v for f, v in zip(self.fit, (1, mb, seconds, mb * mb, mb * seconds))]
+
+    #
+    # Starts the deadline and the polls of the job of up, just created
+    # The first poll is never later than the job is expected to finish
+    #
+    def accepted(self, up):
+        now = time.time()
+        up.accepted_at = now
+        up.pending_at = None
+        up.deadline = now + WAIT_TIME_LIMIT
+        expected = self.expected(up.size / 1048576)
+        up.poll_delay = self.clamp(0.9 * expected if expected is not None else 0)
+        up.next_poll = now + self.clamp(min(self.jitter(up.poll_delay), up.poll_delay))
+
+    def pending(self, up):
+        up.pending_at = time.time()
+        up.poll_delay = self.clamp(2 * up.poll_delay)
+        up.next_poll = up.pending_at + self.clamp(self.jitter(up.poll_delay))
+
+    #
+    # Learns from a job seen SUCCESS. The time until SUCCESS was seen includes the wait for the poll, so
+    # a job already seen PENDING is learnt to end when it was last seen PENDING, and a job done by its
+    # first poll is only learnt when that is sooner than expected
+    #
+    def succeeded(self, up):
+        if (up.size <= 0 or up.accepted_at is None):
+            return
+        mb = up.size / 1048576
+        if up.pending_at is not None:
+            self.learn(mb, up.pending_at - up.accepted_at)
+            return
+        seconds = time.time() - up.accepted_at
+        expected = self.expected(mb)
+        if expected is not None and seconds < expected:
+            self.learn(mb, seconds)
+
+    def failed(self, up):
+        up.resubmit_at = time.time() + self.jitter(RETRY_PAUSE * 2 ** (up.error_count - 1))
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(max(self.rate, 1), self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    #
+    # Takes a token for one status check, False when the rate limit is reached
+    #
+    def take(self):
+        if (self.rate > 0):
+            self.refill()
+            if (self.tokens < 1):
+                return False
+            self.tokens -= 1
+        self.polls += 1
+        return True
+
+    #
+    # Time of the next thing to do for up: a poll (when a token is there) or a resend, None while it is sent
+    #
+    def due(self, up):
+        if up.job_id is None:
+            return up.resubmit_at if up.job is None else None
+        if (self.rate > 0):
+            self.refill()
+            return max(up.next_poll, self.refilled + max(1 - self.tokens, 0) / self.rate)
+        return up.next_poll
+
+
+#
+# Journal of the chunks sent, kept in a sqlite database so an interrupted run can be resumed
+# Each chunk has its pieces (file byte ranges), content hash, job id and status:
+# READ, SUBMITTED, PENDING, SUCCESS, FAILED or STALE (a file changed since it was read)
+# Without a path the journal only lives for the run
+#
+class UploadJournal:
+    def __init__(self, path=None):
+        self.db = sqlite3.connect(path if path else ':memory:')
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks (id INTEGER PRIMARY KEY AUTOINCREMENT, size INTEGER, "
+                        "digest TEXT, job_id TEXT, status TEXT, attempts INTEGER, updated TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS pieces (chunk_id INTEGER, seq INTEGER, fname TEXT, "
+                        "start_byte INTEGER, end_byte INTEGER, npieces INTEGER, fsize INTEGER, fmtime REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pieces_file ON pieces (fname, fsize, fmtime)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS pieces_chunk ON pieces (chunk_id)")
+        self.db.commit()
+
+    def add(self, pieces, size, digest):
+        cur = self.db.execute("INSERT INTO chunks (size, digest, status, attempts, updated) VALUES (?, ?, 'READ', 0, ?)",
+                              (size, digest, str(datetime.datetime.now())))
+        cid = cur.lastrowid
+        self.db.executemany("INSERT INTO pieces VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(cid, seq) + tuple(piece) for seq, piece in enumerate(pieces)])
+        self.db.commit()
+        return cid
+
+    def update(self, cid, status, job_id=None, attempts=0):
+        self.db.execute("UPDATE chunks SET status = ?, job_id = ?, attempts = attempts + ?, updated = ? WHERE id = ?",
+                        (status, job_id, attempts, str(datetime.datetime.now()), cid))
+        self.db.commit()
+
+    #
+    # (id, size, digest, job_id, status) of the chunks in one of statuses
+    #
+    def chunks(self, statuses):
+        return self.db.execute("SELECT id, size, digest, job_id, status FROM chunks WHERE status IN (%s) ORDER BY id" %
+                               ",".join("?" * len(statuses)), statuses).fetchall()
+
+    def digest(self, cid):
+        return self.db.execute("SELECT digest FROM chunks WHERE id = ?", (cid,)).fetchone()[0]
+
+    def pieces(self, cid):
+        return [tuple(row) for row in self.db.execute("SELECT fname, start_byte, end_byte, npieces, fsize, fmtime "
+                                                      "FROM pieces WHERE chunk_id = ? ORDER BY seq", (cid,))]
+
+    #
+    # Byte ranges of the current version of fname in chunks that are not stale, and how many of them are loaded
+    #
+    def ranges(self, fname, fsize, fmtime):
+        rows = self.db.execute("SELECT DISTINCT p.start_byte, p.end_byte, c.status FROM pieces p JOIN chunks c "
+                               "ON p.chunk_id = c.id WHERE p.fname = ? AND p.fsize = ? AND p.fmtime = ? "
+                               "AND c.status != 'STALE'", (fname, fsize, fmtime)).fetchall()
+        journaled = set((row[0], row[1]) for row in rows)
+        loaded = set((row[0], row[1]) for row in rows if row[2] == 'SUCCESS')
+        return journaled, len(loaded)
+
+    #
+    # Drops the loaded pieces of fname once it is moved to done, and the loaded chunks left without pieces
+    # A chunk shared with files not moved yet keeps their pieces
+    #
+    def prune(self, fname):
+        self.db.execute("DELETE FROM pieces WHERE fname = ? AND chunk_id IN "
+                        "(SELECT id FROM chunks WHERE status = 'SUCCESS')", (fname,))
+        self.db.execute("DELETE FROM chunks WHERE status = 'SUCCESS' AND id NOT IN (SELECT chunk_id FROM pieces)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+#
+# True when the files of the pieces are still the ones that were read
+#
+def pieces_unchanged(pieces):
+    for (fname, start, end, npieces, fsize, fmtime) in pieces:
+        if not os.path.exists(fname):
+            return False
+        st = os.stat(fname)
+        if st.st_size != fsize or st.st_mtime != fmtime:
+            return False
+    return True
+
+
+#
+# gzip data a block at a time so the compressor never holds a second copy of the input
+#
+def compress_chunk(data, level):
+    start = time.time()
+    comp = zlib.compressobj(level, zlib.DEFLATED, 31)
+    out = io.BytesIO()
+    with memoryview(data) as view:
+        for i in range(0, len(data), COMPRESS_BLOCK):
+            out.write(comp.compress(view[i:i + COMPRESS_BLOCK]))
+    out.write(comp.flush())
+    packed = out.getvalue()
+    info("Compressed chunk " + str(len(data)) + " -> " + str(len(packed)) + " bytes, ratio " +
+         "%.1f" % (len(data) / max(len(packed), 1)) + " in " + "%.2f" % (time.time() - start) + " s")
+    return packed
+
+
+#
+# Sends a chunk, waiting for its compression first when compressing
+# A chunk resumed from the journal is read again from its pieces when it has to be sent
+#
+def send_chunk(up, ds_id, falkonry, opts):
+    if up.packed is not None:
+        data = up.packed.result()
+        up.data = None  # only the compressed data is kept for retries
+    else:
+        if up.data is None:
+            start = time.time()
+            up.data = assemble_chunk(up.files, bytearray(SIZE_LIMIT))
+            up.read_time += time.time() - start
+        data = up.data
+        if up.level > 0:
+            data = compress_chunk(data, up.level)
+    start = time.time()
+    res = falkonry.add_input_data(ds_id, 'csv', opts, data)
+    elapsed = max(time.time() - start, 0.001)
+    up.send_time += elapsed
+    up.sent_size = len(data)
+    info("Sent " + str(len(data)) + " bytes (" + str(up.size) + " bytes of csv) in " + "%.2f" % elapsed +
+         " s, effective " + "%.2f" % (up.size / 1048576 / elapsed) + " MB/s")
+    return res
+
+
+#
+# Starts (or restarts) the upload of a chunk in the uploader pool
+#
+def submit_upload(up, ds_id, falkonry, uploader, journal=None):
+    up.job = uploader.submit(send_chunk, up, ds_id, falkonry, up.opts)
+    up.job_id = None
+    if journal is not None:
+        journal.update(up.cid, 'SUBMITTED', None, 1)
+
+
+#
+# Checks an upload once, returns True when it is finished and up.status is set
+# The job is only polled when the scheduler says it is due. An upload in ERROR is sent again
+# after a backoff until ERROR_LIMIT is reached, each attempt has its own WAIT_TIME_LIMIT.
+#
+def check_upload(up, ds_id, falkonry, uploader, scheduler, journal=None):
     try:
-        opts = {'streaming': False, 'hasMoreData': False}
-        #
-        # Retry until the API call is successful or error_limit is reached
-        #
-        while processed == 0:
-            res = falkonry.add_input_data(ds_id, 'csv', opts, chunk)
-            while True:
-                tr = falkonry.get_status(res['__$id'])
-                status = tr['status']
-                info("Status:" + status)
-                if status == 'SUCCESS':
-                    processed = 1
-                    status = True
-                    info("Completed loading chunk")
-                    break
-                elif status == 'ERROR':
-                    error_count = error_count + 1
-                    if (error_count >= error_limit):
-                        info("ERROR loading - retrials failed. Skipping chunk")
-                        processed = 1
-                    else:
-                        info("ERROR loading - RETRYING loading")
-                    break
-                elif status == 'PENDING':
-                    if (int(time.time()) - start_time > WAIT_TIME_LIMIT):
-                        info("Skipping after waiting " + str(WAIT_TIME_LIMIT))
-                        processed = 1
-                        break
-                    else:
-                        info("Sleeping...")
-                        time.sleep(pause)
+        if up.job_id is None:
+            if up.job is None:
+                if (time.time() >= up.resubmit_at):
+                    submit_upload(up, ds_id, falkonry, uploader, journal)
+                return False
+            if not up.job.done():
+                return False
+            res = up.job.result()
+            up.job_id = res['__$id']
+            scheduler.accepted(up)
+            if journal is not None:
+                journal.update(up.cid, 'PENDING', up.job_id)
+        if (time.time() < up.next_poll or not scheduler.take()):
+            return False
+        start = time.time()
+        tr = falkonry.get_status(up.job_id)
+        scheduler.poll_time += time.time() - start
+        status = tr['status']
+        info("Status:" + status + " job " + str(up.job_id))
+        if status != 'PENDING':
+            up.pending_time += time.time() - up.accepted_at
+        if status == 'SUCCESS':
+            up.status = True
+            scheduler.succeeded(up)
+            info("Completed loading chunk")
+            return True
+        elif status == 'ERROR':
+            up.error_count = up.error_count + 1
+            if (up.error_count >= ERROR_LIMIT):
+                info("ERROR loading - retrials failed. Skipping chunk")
+                up.status = False
+                return True
+            scheduler.failed(up)
+            info("ERROR loading - RETRYING loading in " + "%.1f" % (up.resubmit_at - time.time()) + " s")
+            if journal is not None:
+                journal.update(up.cid, 'FAILED', up.job_id)
+            up.job = None
+            up.job_id = None
+        elif status == 'PENDING':
+            if (time.time() > up.deadline):
+                up.pending_time += time.time() - up.accepted_at
+                info("Skipping after waiting " + str(WAIT_TIME_LIMIT))
+                up.status = False
+                return True
+            scheduler.pending(up)
+        return False
     except IOError:
         info("IOError... Skipping chunk")
-    except:
+    except Exception:
         #
-        # Other unknown errors
+        # Other unknown errors, an interrupted run is left to the journal
         #
         info("Unknown exception")
-        info(sys.exc_info()[1])
-    finally:
-        return status
+        info(str(sys.exc_info()[1]))
+    up.status = False
+    return True
 
 
-def get_data(fname, is_first):
-    info("Reading file :" + fname + "(is_first=" + str(is_first) + ")")
-    fle = open(fname)
-    #
-    # Skip the first header line if not the first file
-    #
-    if (is_first == False):
-        fle.readline()
-    data = fle.read()
-    fle.close()
-    return data
+#
+# Waits until one of the uploads is due to be checked or has been sent, returns the seconds waited
+#
+def wait_uploads(pending, scheduler):
+    start = time.time()
+    due = [t for t in (scheduler.due(up) for up in pending) if t is not None]
+    timeout = max(min(due) - start, 0) if due else None
+    sending = [up.job for up in pending if up.job is not None and up.job_id is None]
+    if sending:
+        concurrent.futures.wait(sending, timeout, concurrent.futures.FIRST_COMPLETED)
+    elif (timeout > 0):
+        info("Waiting " + "%.1f" % timeout + " s")
+        time.sleep(timeout)
+    return time.time() - start
 
 
 #
-# Main method.
+# Header line of fname and the byte ranges (start, end) of whole lines after it
+# Each range is at most limit bytes minus the header so it fits a chunk with the header repeated
 #
-def pump_data(flist, ds_id, falkonry, dst):
-    count = 0
+def file_pieces(fname, limit):
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as fle:
+        header = fle.readline()
+        limit = max(limit - len(header) - 1, 1)  # room for a missing last newline
+        start = len(header)
+        pieces = []
+        while start < size:
+            end = min(start + limit, size)
+            if end < size:
+                #
+                # Back up to the end of the last whole line in the range
+                #
+                fle.seek(start)
+                nl = fle.read(end - start).rfind(b'\n')
+                if nl >= 0:
+                    end = start + nl + 1
+                else:
+                    #
+                    # A single line longer than the range, send all of it
+                    #
+                    fle.seek(end)
+                    fle.readline()
+                    end = fle.tell()
+            pieces.append((start, end))
+            start = end
+    if len(pieces) == 0:
+        pieces.append((start, start))  # header only, still sent so the file is moved
+    return header, pieces
+
+
+#
+# Yields the pieces of the chunks of at most SIZE_LIMIT bytes (a single longer line is sent whole)
+# for the files of flist, leaving out the byte ranges in skip (from the journal)
+# Files larger than a chunk are split on line boundaries, the header of the first piece of a chunk is kept
+# Files are planned while the chunks before them are loaded, a file gone by then (e.g. moved to done
+# once the chunks it had left from an earlier run loaded) is left out
+#
+def plan_chunks(flist, skip):
     LIMIT = SIZE_LIMIT  # 50MB at a time
-    data = ""
-    status = False
+    pos = 0
     cflist = []
 
+    for fname in flist:
+        try:
+            st = os.stat(fname)
+            header, pieces = file_pieces(fname, LIMIT)
+        except OSError:
+            info("File " + fname + " is no longer there, left out of the chunks")
+            continue
+        done = skip.get(fname, set())
+        for (start, end) in pieces:
+            if (start, end) in done:
+                continue
+            if (pos > 0 and pos + end - start + 1 > LIMIT):
+                yield cflist
+                pos = 0
+                cflist = []  # Reset list
+            if (pos == 0):
+                pos = len(header)
+            pos += end - start + 1
+            cflist.append((fname, start, end, len(pieces), st.st_size, st.st_mtime))
+    if (len(cflist) > 0):
+        yield cflist
+
+
+#
+# Data of a chunk read as bytes into buf (grown when a piece does not fit)
+# The header of the file of the first piece is kept, the others are left out
+#
+def assemble_chunk(pieces, buf):
+    pos = 0
+    for (fname, start, end, npieces, fsize, fmtime) in pieces:
+        info("Reading file :" + fname + " bytes " + str(start) + "-" + str(end))
+        with open(fname, 'rb') as fle:
+            if (pos == 0):
+                header = fle.readline()
+                buf[0:len(header)] = header
+                pos = len(header)
+            need = pos + end - start + 1
+            if (need > len(buf)):
+                buf.extend(bytearray(need - len(buf)))
+            fle.seek(start)
+            with memoryview(buf) as view:
+                fle.readinto(view[pos:pos + end - start])
+        pos += end - start
+        #
+        # Keep the next file from joining a last line without a newline
+        #
+        if (pos > 0 and buf[pos - 1:pos] != b'\n'):
+            buf[pos:pos + 1] = b'\n'
+            pos += 1
+    info("Data size is : " + str(pos))
+    with memoryview(buf) as view:
+        return bytes(view[:pos])
+
+
+#
+# Yields (cid, pieces, data, digest, seconds) for each work item (cid, pieces), reading files into one reused buffer
+# A chunk with a file gone since it was planned is left out
+#
+def read_chunks(items, timing=None):
+    buf = bytearray(SIZE_LIMIT)
+    for (cid, pieces) in items:
+        start = time.time()
+        try:
+            data = assemble_chunk(pieces, buf)
+        except OSError as e:
+            err_msg("Chunk of " + str(sorted(set(piece[0] for piece in pieces))) + " not read: " + str(e))
+            continue
+        if (len(buf) > SIZE_LIMIT):
+            del buf[SIZE_LIMIT:]  # grown for a long line
+        elapsed = time.time() - start
+        if timing is not None:
+            timing['read'] += elapsed
+        yield cid, pieces, data, hashlib.sha1(data).hexdigest(), elapsed
+
+
+#
+# Moves fname to dst when every piece of it is loaded and prunes its loaded chunks from the journal,
+# returns True if it was moved
+#
+def move_if_loaded(fname, npieces, journal, dst):
+    if not os.path.exists(fname):
+        return False
+    st = os.stat(fname)
+    journaled, loaded = journal.ranges(fname, st.st_size, st.st_mtime)
+    if (loaded < npieces):
+        return False
+    shutil.move(fname, dst)
+    journal.prune(fname)
+    return True
+
+
+#
+# Main method.
+# Up to inflight chunks are uploaded at once while the next chunk is read ahead.
+# The status of all pending uploads is polled in one loop.
+# A file is moved to dst once all its pieces are loaded, it fails if any of them fails.
+# With level 1-9 each chunk is gzipped in a compressor thread before it is sent.
+# With a journal, chunks confirmed by an earlier run are skipped, jobs still pending are polled
+# again and chunks that failed are sent again before new ones, unless resume is False.
+# With streaming the chunks are sent with the streaming ingestion options.
+# With metrics each chunk finished is recorded in it.
+#
+def pump_data(flist, ds_id, falkonry, dst, inflight=2, level=0, journal=None, scheduler=None, timing=None,
+              streaming=False, metrics=None, resume=True):
     stat_success_files = 0
     stat_failed_files = 0
     stat_success_size = 0
     stat_failed_size = 0
+    failed_files = set()
+    if journal is None:
+        journal = UploadJournal()
+    if scheduler is None:
+        scheduler = PollScheduler()
+    if timing is None:
+        timing = {}
+    for key in ('read', 'send', 'poll', 'wait'):
+        timing.setdefault(key, 0.0)
 
-    listsize = len(flist)
-    nF = 0
-    for f0 in flist:
-        fname = f0
-        nF += 1
-        cflist.append(fname)
-        data += get_data(fname, (count == 0))
-        count += 1
-        data_size = len(data)
-        if (data_size >= LIMIT or nF >= listsize):
-            info("Data size is : " + str(data_size))
-            status = upload_chunk(data, ds_id, falkonry)
-            data = ''
+    #
+    # Work left by an earlier run
+    #
+    resumed = []
+    retries = []
+    left = journal.chunks(('READ', 'SUBMITTED', 'PENDING', 'FAILED')) if resume else []
+    for (cid, size, digest, job_id, status) in left:
+        pieces = journal.pieces(cid)
+        if not pieces_unchanged(pieces):
+            info("Files of chunk " + str(cid) + " changed since they were read, they are read again")
+            journal.update(cid, 'STALE', job_id)
+        elif (status == 'PENDING' and job_id):
+            info("Resuming job " + str(job_id) + " of chunk " + str(cid))
+            up = ChunkUpload(pieces, None, size, level, streaming)
+            up.cid = cid
+            up.job_id = job_id
+            scheduler.accepted(up)
+            resumed.append(up)
+        else:
+            info("Sending chunk " + str(cid) + " again (" + status + ")")
+            retries.append((cid, pieces))
+    skip = {}
+    for fname in flist:
+        try:
+            st = os.stat(fname)
+            journaled, loaded = journal.ranges(fname, st.st_size, st.st_mtime)
+            npieces = len(file_pieces(fname, SIZE_LIMIT)[1]) if len(journaled) > 0 else 0
+        except OSError:
+            continue
+        if (len(journaled) > 0):
+            skip[fname] = journaled
+            if (move_if_loaded(fname, npieces, journal, dst)):
+                info("Processed files : " + str([fname]) + " (loaded by an earlier run)")
+                stat_success_files += 1
+
+    items = itertools.chain(retries, ((None, pieces) for pieces in plan_chunks(
+        [fname for fname in flist if os.path.exists(fname)], skip)))
+    chunks = read_chunks(items, timing)
+    reader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    uploader = concurrent.futures.ThreadPoolExecutor(max_workers=inflight)
+    compressor = concurrent.futures.ThreadPoolExecutor(max_workers=inflight) if level > 0 else None
+    pending = resumed
+    try:
+        ahead = reader.submit(next, chunks, None)
+        while ahead is not None or pending:
             #
-            # Move processed files
+            # Start uploads while there is room, reading the chunk after each one ahead
             #
-            if (status == True):
-                for fle in cflist:
-                    shutil.move(fle, dst)
-                info("Processed files : " + str(cflist))
-                stat_success_files += len(cflist)
-                stat_success_size += data_size
-            else:
-                info("Skipped processing : " + str(cflist))
-                stat_failed_files += len(cflist)
-                stat_failed_size += data_size
-            count = 0
-            cflist = []  # Reset list
+            while ahead is not None and len(pending) < inflight:
+                start = time.time()
+                chunk = ahead.result()
+                timing['wait'] += time.time() - start
+                if chunk is None:
+                    ahead = None
+                    break
+                ahead = reader.submit(next, chunks, None)
+                (cid, pieces, data, digest, read_time) = chunk
+                if cid is None:
+                    cid = journal.add(pieces, len(data), digest)
+                elif digest != journal.digest(cid):
+                    info("Chunk " + str(cid) + " no longer matches its files, they are read again on the next run")
+                    journal.update(cid, 'STALE')
+                    continue
+                up = ChunkUpload(pieces, data, len(data), level, streaming)
+                up.cid = cid
+                up.read_time = read_time
+                if compressor is not None:
+                    up.packed = compressor.submit(compress_chunk, up.data, level)
+                submit_upload(up, ds_id, falkonry, uploader, journal)
+                pending.append(up)
+
+            finished = [up for up in pending if check_upload(up, ds_id, falkonry, uploader, scheduler, journal)]
+            for up in finished:
+                pending.remove(up)
+                timing['send'] += up.send_time
+                up.data = None
+                up.packed = None
+                journal.update(up.cid, 'SUCCESS' if up.status == True else 'FAILED', up.job_id)
+                if metrics is not None:
+                    metrics.record(up)
+                if (up.status == True):
+                    stat_success_size += up.size
+                else:
+                    stat_failed_size += up.size
+                #
+                # Move processed files
+                #
+                moved = []
+                skipped = []
+                for (fle, start, end, npieces, fsize, fmtime) in up.files:
+                    if (fle in moved or fle in skipped):
+                        continue
+                    if (up.status != True):
+                        if fle not in failed_files:
+                            failed_files.add(fle)
+                            skipped.append(fle)
+                    elif (fle not in failed_files and move_if_loaded(fle, npieces, journal, dst)):
+                        moved.append(fle)
+                if (len(moved) > 0):
+                    info("Processed files : " + str(moved))
+                if (len(skipped) > 0):
+                    info("Skipped processing : " + str(skipped))
+                stat_success_files += len(moved)
+                stat_failed_files += len(skipped)
+            if (pending and not finished):
+                timing['wait'] += wait_uploads(pending, scheduler)
+    finally:
+        reader.shutdown()
+        uploader.shutdown()
+        if compressor is not None:
+            compressor.shutdown()
+        timing['poll'] = scheduler.poll_time
 
     return (stat_success_files, stat_failed_files, stat_success_size, stat_failed_size)
 
 
+#
+# Metrics of the chunks loaded, for monitoring
+# Each chunk finished is appended to a JSON lines log and the totals are rewritten to a file in the
+# Prometheus text format (for the node exporter textfile collector). Either path may be None.
+#
+class LoaderMetrics:
+    def __init__(self, prom_path=None, log_path=None, labels=None):
+        self.prom_path = prom_path
+        self.log = open(log_path, 'a') if log_path else None
+        self.labels = ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                               for k, v in sorted((labels or {}).items()))
+        self.start_time = time.time()
+        self.last_time = 0
+        self.last_rate = 0
+        self.totals = {'chunks_success': 0, 'chunks_failed': 0, 'bytes_read': 0, 'bytes_sent': 0,
+                       'read_seconds': 0.0, 'upload_seconds': 0.0, 'pending_seconds': 0.0, 'retries': 0}
+        self.write_prom()
+
+    def record(self, up):
+        now = time.time()
+        status = 'SUCCESS' if up.status == True else 'FAILED'
+        if self.log is not None:
+            self.log.write(json.dumps({
+                'time': datetime.datetime.fromtimestamp(now).isoformat(),
+                'chunk': up.cid,
+                'files': sorted(set(piece[0] for piece in up.files)),
+                'bytes_read': up.size,
+                'bytes_sent': up.sent_size,
+                'read_seconds': round(up.read_time, 6),
+                'upload_seconds': round(up.send_time, 6),
+                'pending_seconds': round(up.pending_time, 6),
+                'retries': up.error_count,
+                'job_id': up.job_id,
+                'status': status}) + "\n")
+            self.log.flush()
+        self.totals['chunks_success' if status == 'SUCCESS' else 'chunks_failed'] += 1
+        self.totals['bytes_read'] += up.size
+        self.totals['bytes_sent'] += up.sent_size
+        self.totals['read_seconds'] += up.read_time
+        self.totals['upload_seconds'] += up.send_time
+        self.totals['pending_seconds'] += up.pending_time
+        self.totals['retries'] += up.error_count
+        self.last_time = now
+        busy = up.read_time + up.send_time + up.pending_time
+        self.last_rate = up.size / busy if (status == 'SUCCESS' and busy > 0) else 0
+        self.write_prom()
+
+    def metric(self, lines, name, kind, text, value, labels=''):
+        if labels and self.labels:
+            labels = self.labels + "," + labels
+        elif self.labels:
+            labels = self.labels
+        if text is not None:
+            lines.append("# HELP falkonry_loader_" + name + " " + text)
+            lines.append("# TYPE falkonry_loader_" + name + " " + kind)
+        lines.append("falkonry_loader_" + name + ("{" + labels + "}" if labels else "") + " " + repr(value))
+
+    #
+    # Rewrites the Prometheus file, through a temporary file so a scrape never sees half of it
+    #
+    def write_prom(self):
+        if self.prom_path is None:
+            return
+        t = self.totals
+        lines = []
+        self.metric(lines, 'chunks_total', 'counter', 'Chunks finished by status.', t['chunks_success'],
+                    'status="success"')
+        self.metric(lines, 'chunks_total', 'counter', None, t['chunks_failed'], 'status="failed"')
+        self.metric(lines, 'read_bytes_total', 'counter', 'Bytes of csv read into chunks.', t['bytes_read'])
+        self.metric(lines, 'sent_bytes_total', 'counter', 'Bytes sent, compressed when compressing.', t['bytes_sent'])
+        self.metric(lines, 'read_seconds_total', 'counter', 'Seconds spent assembling chunks.', t['read_seconds'])
+        self.metric(lines, 'upload_seconds_total', 'counter', 'Seconds spent sending chunks.', t['upload_seconds'])
+        self.metric(lines, 'pending_seconds_total', 'counter', 'Seconds jobs were PENDING on the server.',
+                    t['pending_seconds'])
+        self.metric(lines, 'retries_total', 'counter',
+                    'Jobs that ended in ERROR, the chunk is sent again below ERROR_LIMIT.', t['retries'])
+        self.metric(lines, 'last_chunk_bytes_per_second', 'gauge',
+                    'Csv bytes per second of reading, sending and processing the last chunk, 0 when it failed.',
+                    self.last_rate)
+        self.metric(lines, 'last_chunk_timestamp_seconds', 'gauge', 'When the last chunk finished.', self.last_time)
+        self.metric(lines, 'start_timestamp_seconds', 'gauge', 'When the loader started.', self.start_time)
+        tmp = self.prom_path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.prom_path)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+
+#
+# Wakes the watch loop when something changes in a directory
+# Uses filesystem notifications when watchdog is installed, polls every poll seconds otherwise
+#
+class DirectoryWatcher:
+    def __init__(self, dirname, poll=1.0):
+        self.poll = poll
+        self.changed = threading.Event()
+        self.observer = None
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            info("watchdog is not installed, scanning " + dirname + " every " + str(poll) + " s")
+            return
+        handler = FileSystemEventHandler()
+        handler.on_any_event = lambda event: self.changed.set()
+        self.observer = Observer()
+        self.observer.schedule(handler, dirname, recursive=False)
+        self.observer.start()
+        info("Watching " + dirname + " for changes")
+
+    #
+    # Waits for a change or timeout seconds (None waits for a change)
+    # With notifications the directory is still scanned every poll seconds, in case one was missed
+    #
+    def wait(self, timeout):
+        timeout = self.poll if timeout is None else min(timeout, self.poll)
+        if self.observer is None:
+            time.sleep(timeout)
+        else:
+            self.changed.wait(timeout)
+            self.changed.clear()
+
+    def close(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+
+#
+# Loads the csv files arriving in dirname until interrupted, with one client, journal and poll scheduler
+# A file is taken once it has not changed for settle seconds. The files taken are loaded with streaming
+# ingestion as soon as they total batch_size bytes or the oldest has waited batch_time seconds.
+# A file that failed is only taken again once it changes.
+#
+def watch_data(dirname, ds_id, falkonry, dst, inflight=2, level=0, journal=None, scheduler=None, timing=None,
+               batch_size=SIZE_LIMIT, batch_time=5, settle=2, poll=1.0, metrics=None):
+    stats = [0, 0, 0, 0]
+    if journal is None:
+        journal = UploadJournal()
+    if scheduler is None:
+        scheduler = PollScheduler()
+    if timing is None:
+        timing = {}
+    for key in ('read', 'send', 'poll', 'wait'):
+        timing.setdefault(key, 0.0)
+    resume = True
+    seen = {}  # name -> ((size, mtime), time of the last change)
+    failed = {}  # name -> (size, mtime) when it failed
+    watcher = DirectoryWatcher(dirname, poll)
+    try:
+        while True:
+            now = time.time()
+            current = {}
+            for fname in glob.glob(os.path.join(dirname, '*.csv')):
+                try:
+                    st = os.stat(fname)
+                except OSError:
+                    continue
+                key = (st.st_size, st.st_mtime)
+                if (failed.get(fname) == key):
+                    continue
+                failed.pop(fname, None)
+                if (fname in seen and seen[fname][0] == key):
+                    current[fname] = seen[fname]
+                else:
+                    current[fname] = (key, min(now, st.st_mtime))
+            seen = current
+            ready = sorted((changed, fname) for fname, (key, changed) in seen.items() if now - changed >= settle)
+            ready_size = sum(seen[fname][0][0] for (changed, fname) in ready)
+            if (ready and (ready_size >= batch_size or now - ready[0][0] - settle >= batch_time)):
+                batch = [fname for (changed, fname) in ready]
+                info("Loading " + str(len(batch)) + " files (" + str(ready_size) + " bytes)")
+                res = pump_data(batch, ds_id, falkonry, dst, inflight, level, journal, scheduler, timing, True,
+                                metrics, resume)
+                # work left by an earlier run is only taken up once, a chunk that failed in this session
+                # is sent again with its file once the file changes
+                resume = False
+                stats = [total + n for total, n in zip(stats, res)]
+                for fname in batch:
+                    key = seen.pop(fname)[0]
+                    if os.path.exists(fname):
+                        failed[fname] = key
+                continue
+            #
+            # Sleep until the next file settles or the oldest file waiting is due, or something changes
+            #
+            due = [changed + settle for (key, changed) in seen.values() if now - changed < settle]
+            if ready:
+                due.append(ready[0][0] + settle + batch_time)
+            wait_start = time.time()
+            watcher.wait(max(min(due) - now, 0.05) if due else None)
+            timing['wait'] += time.time() - wait_start
+    except KeyboardInterrupt:
+        info("Stopped watching " + dirname)
+    finally:
+        watcher.close()
+    return tuple(stats)
+
+
 #
 # The main method
 #
@@ -152,6 +887,27 @@ def main():
     parser.add_argument('name', metavar='n', nargs=1, help='datastream')
     parser.add_argument('file', metavar='f', nargs=1, help='token file')
     parser.add_argument('data', metavar='d', nargs=1, help='source directory')
+    parser.add_argument('--inflight', type=int, default=2, help='number of chunks uploaded at once')
+    parser.add_argument('--compress', type=int, default=0, choices=range(0, 10), metavar='LEVEL',
+                        help='gzip level (1-9) of the chunks sent, the endpoint must accept gzipped data. 0 sends plain csv')
+    parser.add_argument('--journal', default=None,
+                        help="sqlite journal of the chunks sent, used to resume an interrupted run. "
+                             "Default=upload_journal.db in the source directory, 'none' keeps no journal")
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running and load csv files as they arrive, with streaming ingestion. Ctrl-C stops')
+    parser.add_argument('--batch-mb', type=float, default=SIZE_LIMIT / 1048576,
+                        help='with --watch, load the files waiting once they total this many MB')
+    parser.add_argument('--batch-seconds', type=float, default=5,
+                        help='with --watch, load the files waiting once the oldest has waited this long')
+    parser.add_argument('--settle', type=float, default=2,
+                        help='with --watch, seconds a file must be unchanged before it is loaded')
+    parser.add_argument('--watch-poll', type=float, default=1,
+                        help='with --watch, seconds between scans of the source directory when watchdog is not installed')
+    parser.add_argument('--metrics-prom', default=None,
+                        help='file the chunk metrics are written to in the Prometheus text format, rewritten after each chunk')
+    parser.add_argument('--metrics-log', default=None, help='JSON lines file each chunk finished is appended to')
+    parser.add_argument('--poll-rate', type=float, default=POLL_RATE,
+                        help='most status checks per second over all chunks in flight, 0 does not limit them')
 
     args = parser.parse_args()
     dsname = str(args.name[0])
@@ -173,12 +929,13 @@ def main():
     src = pref + '*.csv'
     dst = pref + 'done/'  # if this does not exist, files will be copied to a file named 'done'
 
-    # instantiate Falkonry
+    # instantiate Falkonry, imported here so the loader functions can be used (e.g. by LoaderBenchmark) without it
+    from falkonryclient import client as Falkonry
     falkonry = Falkonry('https://awo-op-falk01:30061', token, None)
 
     dsid = ''
 
-    p_start_time = int(time.time())
+    p_start_time = time.time()
     # can replace this with ds ID
     datastreams = falkonry.get_datastreams()
     for ds in datastreams:
@@ -189,18 +946,45 @@ def main():
         err_msg("Could not find datastream named " + dsname)
         sys.exit()
 
-    flist = glob.glob(src)
-    (stat_success_files, stat_failed_files, stat_success_size, stat_failed_size) = pump_data(flist, dsid, falkonry, dst)
-    p_end_time = int(time.time())
+    if args.journal is None:
+        journal = UploadJournal(pref + 'upload_journal.db')
+    elif args.journal.lower() == 'none':
+        journal = UploadJournal()
+    else:
+        journal = UploadJournal(args.journal)
+
+    scheduler = PollScheduler(max(args.poll_rate, 0))
+    timing = {}
+    metrics = None
+    if (args.metrics_prom or args.metrics_log):
+        metrics = LoaderMetrics(args.metrics_prom, args.metrics_log, {'datastream': dsname})
+    if args.watch:
+        (stat_success_files, stat_failed_files, stat_success_size, stat_failed_size) = watch_data(
+            pref, dsid, falkonry, dst, max(args.inflight, 1), args.compress, journal, scheduler, timing,
+            int(args.batch_mb * 1048576), args.batch_seconds, args.settle, args.watch_poll, metrics)
+        nfiles = stat_success_files + stat_failed_files
+    else:
+        flist = glob.glob(src)
+        (stat_success_files, stat_failed_files, stat_success_size, stat_failed_size) = pump_data(
+            flist, dsid, falkonry, dst, max(args.inflight, 1), args.compress, journal, scheduler, timing,
+            False, metrics)
+        nfiles = len(flist)
+    journal.close()
+    if metrics is not None:
+        metrics.close()
+    p_end_time = time.time()
 
     #
     # Summary
     #
-    info("Processing time is :" + str(p_end_time - p_start_time) + " seconds")
-    info("Processed " + str(stat_success_files) + " files successfully out of total " + str(len(flist)))
-    info("Failed to process " + str(stat_failed_files) + " files out of total " + str(len(flist)))
+    info("Processing time is :" + "%.1f" % (p_end_time - p_start_time) + " seconds")
+    info("Processed " + str(stat_success_files) + " files successfully out of total " + str(nfiles))
+    info("Failed to process " + str(stat_failed_files) + " files out of total " + str(nfiles))
     info("Data transfer rate = " + str(
-        int((stat_success_size + stat_failed_size) / (p_end_time - p_start_time))) + " bytes per second.")
+        int((stat_success_size + stat_failed_size) / max(p_end_time - p_start_time, 0.001))) + " bytes per second.")
+    info("Time working : reading " + "%.1f" % timing['read'] + " s, sending " + "%.1f" % timing['send'] +
+         " s, polling " + "%.1f" % timing['poll'] + " s (" + str(scheduler.polls) + " status checks)")
+    info("Time waiting for uploads and jobs : " + "%.1f" % timing['wait'] + " s")
 
     #
     # Check to see if any files are skipped
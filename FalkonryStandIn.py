@@ -0,0 +1,114 @@
+import threading
+import random
+import time
+import zlib
+
+
+#
+# Datastream returned by get_datastreams
+#
+class StandInDatastream:
+    def __init__(self, ds_id, name):
+        self.ds_id = ds_id
+        self.name = name
+
+    def get_id(self):
+        return self.ds_id
+
+    def get_name(self):
+        return self.name
+
+
+#
+# Job created by add_input_data, done at done_at with status
+#
+class StandInJob:
+    def __init__(self, job_id, ds_id, size, received_at, done_at, status):
+        self.job_id = job_id
+        self.ds_id = ds_id
+        self.size = size  # bytes of csv, after gunzip for gzipped data
+        self.received_at = received_at  # when add_input_data was called
+        self.done_at = done_at
+        self.status = status
+        self.seen_at = None  # when get_status first returned SUCCESS or ERROR
+        self.polls = 0
+
+
+#
+# Local stand-in for the Falkonry client, used to exercise the loader without the server
+# Each call takes latency seconds (plus the time to receive the data at bandwidth MB/s) before it returns.
+# Jobs are processed one after the other at rate MB/s of csv and stay PENDING for at least pending seconds.
+# A job ends in ERROR with probability errors, every job ends in SUCCESS otherwise.
+# A rate or bandwidth of 0 is unlimited.
+#
+class StandInClient:
+    def __init__(self, datastreams=('stand-in',), latency=0.05, bandwidth=0, rate=50, pending=1.0, errors=0.0,
+                 seed=None):
+        self.datastreams = [StandInDatastream('ds' + str(n), name) for n, name in enumerate(datastreams)]
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.rate = rate
+        self.pending = pending
+        self.errors = errors
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.busy_until = 0  # when the jobs accepted so far are processed
+        self.bytes_received = 0
+        self.calls = {'get_datastreams': 0, 'add_input_data': 0, 'get_status': 0}
+
+    def call(self, name, transfer=0):
+        with self.lock:
+            self.calls[name] += 1
+        delay = self.latency
+        if (self.bandwidth > 0):
+            delay += transfer / 1048576 / self.bandwidth
+        if (delay > 0):
+            time.sleep(delay)
+
+    def get_datastreams(self):
+        self.call('get_datastreams')
+        return list(self.datastreams)
+
+    def add_input_data(self, ds_id, fmt, opts, data):
+        received_at = time.time()
+        self.call('add_input_data', len(data))
+        if ds_id not in [ds.get_id() for ds in self.datastreams]:
+            raise Exception("No datastream " + str(ds_id))
+        if fmt != 'csv':
+            raise Exception("Unsupported format " + str(fmt))
+        if data[:2] == b'\x1f\x8b':
+            size = len(zlib.decompress(bytes(data), 31))
+        else:
+            size = len(data)
+        with self.lock:
+            now = time.time()
+            work = size / 1048576 / self.rate if self.rate > 0 else 0
+            self.busy_until = max(self.busy_until, now) + work
+            status = 'ERROR' if self.random.random() < self.errors else 'SUCCESS'
+            job_id = 'job' + str(len(self.jobs) + 1)
+            self.jobs[job_id] = StandInJob(job_id, ds_id, size, received_at,
+                                           max(self.busy_until, now + self.pending), status)
+            self.bytes_received += len(data)
+        return {'__$id': job_id, 'status': 'PENDING'}
+
+    def get_status(self, job_id):
+        self.call('get_status')
+        with self.lock:
+            if job_id not in self.jobs:
+                raise Exception("No job " + str(job_id))
+            job = self.jobs[job_id]
+            job.polls += 1
+            now = time.time()
+            if (now < job.done_at):
+                return {'__$id': job_id, 'status': 'PENDING'}
+            if job.seen_at is None:
+                job.seen_at = now
+            return {'__$id': job_id, 'status': job.status}
+
+    #
+    # Jobs in the order they were created
+    #
+    def job_list(self):
+        with self.lock:
+            return sorted(self.jobs.values(), key=lambda job: job.received_at)
@@ -0,0 +1,51 @@
+import numpy as np
+
+# gap statistics on int64 nanosecond time deltas
+# no per-gap python objects, every function is a few numpy passes over the deltas
+nat=np.iinfo(np.int64).min
+
+# deltas between consecutive int64 ns times
+def deltas(t):
+    return np.diff(np.asarray(t,dtype=np.int64))
+
+# median of the deltas in ns (mean of middle values like pandas, rounded down), nat if empty
+def median(dt):
+    n=dt.shape[0]
+    if(n==0):
+        return nat
+    part=np.partition(dt,[(n-1)//2,n//2])
+    lo=int(part[(n-1)//2])
+    hi=int(part[n//2])
+    return lo+(hi-lo)//2
+
+# deltas that are gaps: >= gap and, when limit>0, <= limit
+def gapmask(dt,gap,limit=0):
+    mask=dt>=gap
+    if(limit>0):
+        mask&=dt<=limit
+    return mask
+
+# number of gaps
+def gapcount(dt,gap,limit=0):
+    return int(np.count_nonzero(gapmask(dt,gap,limit)))
+
+# count, sum, min, max and mean (ns) of the gaps, min/max/mean are nat when there are none
+def gapstats(dt,gap,limit=0):
+    gaps=dt[gapmask(dt,gap,limit)]
+    cnt=gaps.shape[0]
+    if(cnt==0):
+        return 0,0,nat,nat,nat
+    sm=int(gaps.sum())
+    return cnt,sm,int(gaps.min()),int(gaps.max()),sm//cnt
+
+# intervals needed to fill the gaps with steps of gap: the whole steps plus the fraction left of each gap
+def fillintervals(dt,gap,limit=0):
+    gaps=dt[gapmask(dt,gap,limit)]
+    return int((gaps//gap).sum())+gaps.shape[0]
+
+# deltas once the gaps are filled: other deltas, whole steps of gap and the fraction left of each gap
+def filldeltas(dt,gap,limit=0):
+    mask=gapmask(dt,gap,limit)
+    gaps=dt[mask]
+    full=gaps//gap
+    return np.concatenate([dt[~mask],np.full(int(full.sum()),gap,dtype=np.int64),gaps-full*gap])
@@ -0,0 +1,180 @@
+import FalkonryCSVFileLoader as loader
+from FalkonryStandIn import StandInClient
+import sys, os
+import glob, shutil
+import argparse
+import time
+import json
+import datetime
+import random
+import tempfile
+
+
+#
+# Writes nfiles narrow csv files (time, signal, value) of about mb MB each to dirname
+#
+def make_files(dirname, nfiles, mb, signals=20, seed=0):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2020, 1, 1)
+    step = datetime.timedelta(milliseconds=100)
+    for n in range(nfiles):
+        fname = os.path.join(dirname, "bench_" + str(n) + ".csv")
+        size = 0
+        row = 0
+        with open(fname, 'w') as f:
+            f.write("time,signal,value\n")
+            while size < mb * 1048576:
+                ts = start + (n * 10000000 + row) * step
+                lines = "".join("%s,signal%d,%.4f\n" % ((ts + k * step).isoformat(' ', 'milliseconds'),
+                                                         (row + k) % signals, rnd.uniform(-100, 100))
+                                for k in range(1000))
+                f.write(lines)
+                size += len(lines)
+                row += 1000
+
+
+#
+# Peak resident memory of the process in MB, reset to the current usage where the kernel allows it
+#
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (IOError, OSError):
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+#
+# Nearest rank percentile of the sorted values
+#
+def percentile(values, p):
+    if len(values) == 0:
+        return 0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+#
+# Runs pump_data over the files in dirname against the stand-in and returns the measures
+#
+def run(dirname, falkonry, args):
+    ds_id = falkonry.get_datastreams()[0].get_id()
+    dst = os.path.join(dirname, 'done') + '/'
+    os.makedirs(dst, exist_ok=True)
+    flist = sorted(glob.glob(os.path.join(dirname, '*.csv')))
+    total = sum(os.path.getsize(fname) for fname in flist)
+    scheduler = loader.PollScheduler(max(args.poll_rate, 0))
+    timing = {}
+    reset_peak_rss()
+    start = time.time()
+    (success_files, failed_files, success_size, failed_size) = loader.pump_data(
+        flist, ds_id, falkonry, dst, max(args.inflight, 1), args.compress, loader.UploadJournal(), scheduler, timing)
+    elapsed = max(time.time() - start, 0.001)
+    jobs = falkonry.job_list()
+    latency = sorted(job.seen_at - job.received_at for job in jobs if job.seen_at is not None)
+    lag = sorted(job.seen_at - job.done_at for job in jobs if job.seen_at is not None)
+    return {
+        'files': len(flist),
+        'mb': total / 1048576,
+        'seconds': elapsed,
+        'mb_per_s': success_size / 1048576 / elapsed,
+        'success_files': success_files,
+        'failed_files': failed_files,
+        'success_mb': success_size / 1048576,
+        'failed_mb': failed_size / 1048576,
+        'jobs': len(jobs),
+        'errors': len([job for job in jobs if job.status == 'ERROR']),
+        'sent_mb': falkonry.bytes_received / 1048576,
+        'status_checks': falkonry.calls['get_status'],
+        'latency_p50': percentile(latency, 50),
+        'latency_p90': percentile(latency, 90),
+        'latency_p99': percentile(latency, 99),
+        'latency_max': latency[-1] if latency else 0,
+        'poll_lag_p50': percentile(lag, 50),
+        'poll_lag_max': lag[-1] if lag else 0,
+        'peak_mb': peak_rss_mb(),
+        'timing': timing,
+    }
+
+
+#
+# The main method
+#
+def main():
+    parser = argparse.ArgumentParser(description='Measures FalkonryCSVFileLoader against a local stand-in of the server.')
+    parser.add_argument('--files', type=int, default=8, help='number of synthetic csv files')
+    parser.add_argument('--file-mb', type=float, default=20, help='size of each synthetic file in MB')
+    parser.add_argument('--data', default=None,
+                        help='directory of csv files to load instead of synthetic ones, they are copied first')
+    parser.add_argument('--chunk-mb', type=float, default=loader.SIZE_LIMIT / 1048576, help='chunk size limit in MB')
+    parser.add_argument('--inflight', type=int, default=2, help='number of chunks uploaded at once')
+    parser.add_argument('--compress', type=int, default=0, choices=range(0, 10), metavar='LEVEL',
+                        help='gzip level (1-9) of the chunks sent, 0 sends plain csv')
+    parser.add_argument('--poll-rate', type=float, default=loader.POLL_RATE,
+                        help='most status checks per second over all chunks in flight, 0 does not limit them')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds each call to the stand-in takes')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='MB/s the stand-in receives data at, 0 is unlimited')
+    parser.add_argument('--rate', type=float, default=50, help='MB/s of csv the stand-in processes, 0 is unlimited')
+    parser.add_argument('--pending', type=float, default=1.0, help='least seconds a job stays PENDING')
+    parser.add_argument('--errors', type=float, default=0.0, help='fraction of jobs that end in ERROR')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data and of the injected errors')
+    parser.add_argument('--report', default=None, help='json file the measures are written to')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+
+    args = parser.parse_args()
+    loader.SIZE_LIMIT = int(args.chunk_mb * 1048576)
+    workdir = tempfile.mkdtemp(prefix='loaderbench_')
+    try:
+        if args.data is not None:
+            if not os.path.isdir(args.data):
+                loader.err_msg("no input directory found: " + args.data)
+                sys.exit()
+            for fname in glob.glob(os.path.join(args.data, '*.csv')):
+                shutil.copy(fname, workdir)
+        else:
+            loader.info("Writing " + str(args.files) + " files of " + str(args.file_mb) + " MB to " + workdir)
+            make_files(workdir, args.files, args.file_mb, seed=args.seed)
+        falkonry = StandInClient(latency=args.latency, bandwidth=args.bandwidth, rate=args.rate,
+                                 pending=args.pending, errors=args.errors, seed=args.seed)
+        res = run(workdir, falkonry, args)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    #
+    # Report
+    #
+    info = loader.info
+    info("Loaded " + "%.1f" % res['success_mb'] + " MB of " + "%.1f" % res['mb'] + " MB (" + str(res['files']) +
+         " files) in " + "%.2f" % res['seconds'] + " s = " + "%.2f" % res['mb_per_s'] + " MB/s")
+    info("Files loaded " + str(res['success_files']) + ", failed " + str(res['failed_files']) +
+         ", jobs " + str(res['jobs']) + " (" + str(res['errors']) + " in ERROR), sent " + "%.1f" % res['sent_mb'] +
+         " MB, status checks " + str(res['status_checks']))
+    info("Chunk latency p50 " + "%.2f" % res['latency_p50'] + " s, p90 " + "%.2f" % res['latency_p90'] +
+         " s, p99 " + "%.2f" % res['latency_p99'] + " s, max " + "%.2f" % res['latency_max'] + " s")
+    info("Delay from job done to status seen p50 " + "%.2f" % res['poll_lag_p50'] + " s, max " +
+         "%.2f" % res['poll_lag_max'] + " s")
+    info("Time reading " + "%.1f" % res['timing']['read'] + " s, sending " + "%.1f" % res['timing']['send'] +
+         " s, polling " + "%.1f" % res['timing']['poll'] + " s, waiting " + "%.1f" % res['timing']['wait'] + " s")
+    info("Peak memory " + "%.0f" % res['peak_mb'] + " MB")
+    if args.report is not None:
+        res['args'] = vars(args)
+        with open(args.report, 'w') as f:
+            json.dump(res, f, indent=2)
+        info("Report written to " + args.report)
+
+
+if __name__ == '__main__':
+    main()
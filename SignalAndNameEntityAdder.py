@@ -2,9 +2,15 @@ import sys
 import os
 import csv
 import re
+import io
+import time
+import contextlib
+import traceback
+import concurrent.futures
+from collections import OrderedDict
 
 def usage():
-    print("Usage: python SignalAndEntityAdder.py [-h] -i inputDir [-o outDir] -m mapFile -s sizeMB")
+    print("Usage: python SignalAndEntityAdder.py [-h] -i inputDir [-o outDir] -m mapFile -s sizeMB [-j workers] [-k shardBy] [-n maxOpen]")
     print("where:")
     print("\t-h - OPTIONAL displays these instructions.")
     print("\tinputDir - Path to input directory containing files")
@@ -13,6 +19,11 @@ def usage():
     print("\tsizeMB - The maximum size of the resulting files")
     print("\toutputDir - OPTIONAL - Path to output directory where to place created files.")
     print("\t\tDefault=Output (subdirectory added to input directory")
+    print("\tworkers - OPTIONAL number of tag files processed in parallel, largest first. Default=1")
+    print("\tshardBy - OPTIONAL what each output file covers: tag, entity or entitysignal. Default=tag")
+    print("\t\tentity and entitysignal write the rows of all tags to one set of files per entity (or entity and signal)")
+    print("\t\tin a single pass, e.g. Compressor1_0.csv or Compressor1_InletTemp_0.csv. workers is not used.")
+    print("\tmaxOpen - OPTIONAL most output files kept open at once when sharding. Default=%s" % maxopen)
     print("Program creates files to be imported into Falkonry not to exceed sepecified size in MB from")
     print("csv files generated from PI in the format timestamp,value (no header).")
     print("The file name is assumed to be the name of the PI point/tag (e.g. 20272PI.PV.csv for tag 20272PI.PV.")
@@ -46,6 +57,9 @@ def processargs():
     outdir = None
     filesize = None
     mapfile = None
+    workers = 1
+    shardby = "tag"
+    openfiles = maxopen
     # Arg processing
     if((len(sys.argv)>1 and "-h" in map(lambda a:a.lower(),sys.argv)) or len(sys.argv)<7 ):
         usage()
@@ -67,6 +81,29 @@ def processargs():
                 sys.exit(1)
         elif arg == "-m":
             mapfile = val
+        elif arg == "-j":
+            try:
+                workers=int(val)
+                if(workers<=0):
+                    print("workers must be a positive integer")
+                    sys.exit(1)
+            except ValueError:
+                print("%s is not a valid integer value for workers" % val)
+                sys.exit(1)
+        elif arg == "-k":
+            shardby = val.lower()
+            if(shardby not in shardmodes):
+                print("%s is not a valid value for shardBy, use one of %s" % (val,", ".join(shardmodes)))
+                sys.exit(1)
+        elif arg == "-n":
+            try:
+                openfiles=int(val)
+                if(openfiles<=0):
+                    print("maxOpen must be a positive integer")
+                    sys.exit(1)
+            except ValueError:
+                print("%s is not a valid integer value for maxOpen" % val)
+                sys.exit(1)
         else:
             print("Unknown argument %s" % arg)
     if(not indir):
@@ -81,7 +118,7 @@ def processargs():
     elif (not os.path.exists(mapfile)):
         print("Map file %s does not exist" % indir)
         sys.exit(1)
-    return indir,outdir,mapfile,filesize
+    return indir,outdir,mapfile,filesize,workers,shardby,openfiles
 
 def handleoutputdir(outdir,indir):
     if(not outdir):
@@ -112,9 +149,277 @@ def getmappings(mapfile):
             mappings[tag][signal].add(entity)
     return mappings
 
+# bytes collected before they are written out
+writebuffer=8*1024*1024
+# output modes, and the most output files open at once and bytes collected per file when sharding
+shardmodes=["tag","entity","entitysignal"]
+maxopen=256
+shardbuffer=256*1024
+
+# encoded ",signal,entity<newline>" suffixes of each signal of a tag, in the order lines are written
+# entities are sorted so the output is the same in every process
+def encodesuffixes(signals):
+    return [[(",%s,%s%s" % (signal,entity,os.linesep)).encode('UTF-8') for entity in sorted(entities)]
+            for signal,entities in signals.items()]
+
+# writes the lines of a tag to fileprefix_N.csv files of at most about limit bytes
+# lines are collected in a buffer and written in big blocks, a file is rolled over (exactly as if each line
+# was written on its own) once it reaches limit bytes after the lines of a signal
+class RollingWriter:
+    def __init__(self,outdir,fileprefix,limit,header,buffersize=writebuffer):
+        self.outdir=outdir
+        self.fileprefix=fileprefix
+        self.limit=limit
+        self.header=header
+        self.buffersize=buffersize
+        self.buf=bytearray()
+        self.fout=None
+        self.fn=0
+        self.sizeBytes=0
+        self.fpath=None
+        self.files=0
+        self.written=0
+
+    # adds the lines of one signal
+    def add(self,block):
+        if(self.fout is None):
+            self.fpath="%s%s%s_%s.csv" % (self.outdir, os.sep, self.fileprefix, self.fn)
+            self.fout=open(self.fpath,'wb')
+            self.files+=1
+            self.buf+=self.header
+            self.sizeBytes=len(self.header)
+        self.buf+=block
+        self.sizeBytes+=len(block)
+        if(self.sizeBytes>=self.limit):
+            self.fn+=1
+            self.close()
+        elif(len(self.buf)>=self.buffersize):
+            self.flush()
+
+    def flush(self):
+        if(self.buf):
+            self.fout.write(self.buf)
+            self.written+=len(self.buf)
+            del self.buf[:]
+
+    def close(self):
+        if(self.fout is not None):
+            try:
+                self.flush()
+            finally:
+                self.fout.close()
+                self.fout=None
+
+# writes timestamp,value,signal,entity lines for each row of the tag file at path, returns rows, files and bytes
+def processtag(path,outdir,fileprefix,signals,filesize):
+    suffixes=encodesuffixes(signals)
+    header=("timestamp,value,signal,entity%s" % os.linesep).encode('UTF-8')
+    writer=RollingWriter(outdir,fileprefix,filesize*1024*1024,header)
+    rows=0
+    with open(path) as fin:
+        reader=csv.reader(fin)
+        try:
+            for line in reader:
+                # "timestamp,value" is encoded once per row and joined to the suffixes of each signal
+                prefix=("%s,%s" % (line[0],line[1])).encode('UTF-8')
+                for ends in suffixes:
+                    writer.add(prefix+prefix.join(ends))
+                rows+=1
+        except IOError:
+            print("IO Error when writing to file %s" % writer.fpath)
+        finally:
+            # close last file for that tag
+            writer.close()
+    return rows,writer.files,writer.written
+
+# output file prefix of name with special characters replaced, not in used
+# a prefix already taken (e.g. by A_PV for A.PV) gets a number so no output is overwritten
+def uniqueprefix(name,used):
+    base=re.sub('\W+','_',name)
+    fileprefix=base
+    n=1
+    while(fileprefix in used):
+        n+=1
+        fileprefix="%s_%s" % (base,n)
+    used.add(fileprefix)
+    return fileprefix
+
+# (file, tag, output file prefix) of the tag files, in file name order
+def tagprefixes(files):
+    tagfiles=[]
+    used=set()
+    for f in sorted(files):
+        start=f.rfind(os.sep)
+        end=f.lower().index(".csv")
+        # get tagname
+        tagname=f[(start+1):end]
+        tagfiles.append((f,tagname,uniqueprefix(tagname,used)))
+    return tagfiles
+
+# output files of one shard, rolled over like RollingWriter once a file reaches limit bytes
+class Shard:
+    def __init__(self,name,fileprefix):
+        self.name=name
+        self.fileprefix=fileprefix
+        self.buf=bytearray()
+        self.fn=0
+        self.sizeBytes=0  # of the current file, 0 when the next line starts a new file
+        self.created=False  # the current file exists on disk
+        self.rows=0
+        self.files=0
+        self.written=0
+
+# writes many shards in one pass
+# each shard collects its lines in a buffer, open files are kept in an LRU pool of at most maxopen
+# so thousands of shards can be written without running out of file handles
+class ShardPool:
+    def __init__(self,outdir,limit,header,maxopen=maxopen,buffersize=shardbuffer):
+        self.outdir=outdir
+        self.limit=limit
+        self.header=header
+        self.maxopen=maxopen
+        self.buffersize=buffersize
+        self.shards={}
+        self.used=set()
+        self.handles=OrderedDict()  # shard -> open file, least recently used first
+        self.opened=0
+
+    # the shard of key (an entity or an (entity, signal) pair), its files are named after name
+    def shard(self,key,name):
+        if(key not in self.shards):
+            self.shards[key]=Shard(name,uniqueprefix(name,self.used))
+        return self.shards[key]
+
+    def fpath(self,shard):
+        return "%s%s%s_%s.csv" % (self.outdir, os.sep, shard.fileprefix, shard.fn)
+
+    # adds one line to a shard
+    def add(self,shard,line):
+        if(shard.sizeBytes==0):
+            shard.buf+=self.header
+            shard.sizeBytes=len(self.header)
+            shard.files+=1
+        shard.buf+=line
+        shard.sizeBytes+=len(line)
+        shard.rows+=1
+        if(shard.sizeBytes>=self.limit):
+            self.flush(shard,True)
+            shard.fn+=1
+            shard.sizeBytes=0
+            shard.created=False
+        elif(len(shard.buf)>=self.buffersize):
+            self.flush(shard)
+
+    # writes out the buffer of a shard, the file is closed when it is complete
+    def flush(self,shard,complete=False):
+        if(shard.buf):
+            fout=self.handles.pop(shard,None)
+            if(fout is None):
+                if(len(self.handles)>=self.maxopen):
+                    self.handles.popitem(last=False)[1].close()
+                fout=open(self.fpath(shard),'ab' if shard.created else 'wb')
+                shard.created=True
+                self.opened+=1
+            self.handles[shard]=fout
+            fout.write(shard.buf)
+            shard.written+=len(shard.buf)
+            del shard.buf[:]
+        if(complete and shard in self.handles):
+            self.handles.pop(shard).close()
+
+    def flushall(self):
+        for shard in self.shards.values():
+            self.flush(shard)
+
+    def close(self):
+        try:
+            self.flushall()
+        finally:
+            for fout in self.handles.values():
+                fout.close()
+            self.handles.clear()
+
+# writes the lines of the tag file at path to the shards of each entity (or entity and signal), returns rows
+def processtagsharded(path,pool,signals,shardby):
+    # the shard and encoded ",signal,entity<newline>" suffix of each line of a row
+    ends=[]
+    for signal,entities in signals.items():
+        for entity in sorted(entities):
+            if(shardby=="entity"):
+                shard=pool.shard(entity,entity)
+            else:
+                shard=pool.shard((entity,signal),"%s_%s" % (entity,signal))
+            ends.append((shard,(",%s,%s%s" % (signal,entity,os.linesep)).encode('UTF-8')))
+    rows=0
+    with open(path) as fin:
+        reader=csv.reader(fin)
+        for line in reader:
+            prefix=("%s,%s" % (line[0],line[1])).encode('UTF-8')
+            for shard,end in ends:
+                pool.add(shard,prefix+end)
+            rows+=1
+    # buffers only hold the lines of the tag being read
+    pool.flushall()
+    return rows
+
+# processes all tag files into entity (or entity and signal) shards, returns the summaries of the shards
+def processsharded(tagfiles,indir,outdir,tags,filesize,shardby,openfiles):
+    header=("timestamp,value,signal,entity%s" % os.linesep).encode('UTF-8')
+    pool=ShardPool(outdir,filesize*1024*1024,header,openfiles)
+    try:
+        for f,tagname,fileprefix in tagfiles:
+            print("processing values for tag %s" % tagname)
+            if(tagname not in tags):
+                raise KeyError("tag %s is not in the map file" % tagname)
+            rows=processtagsharded("%s%s%s" % (indir,os.sep,f),pool,tags[tagname],shardby)
+            print("%s rows of tag %s written to %s shards" % (rows,tagname,len(pool.shards)))
+    except IOError:
+        print("IO Error when writing to directory %s" % outdir)
+    finally:
+        pool.close()
+    print("%s files opened for %s shards (at most %s open at once)" % (pool.opened,len(pool.shards),openfiles))
+    return [{'tag':shard.name,'rows':shard.rows,'files':shard.files,'bytes':shard.written,'seconds':None}
+            for shard in pool.shards.values()]
+
+# processes the file of one tag, returns its summary
+def processfile(f,tagname,fileprefix,indir,outdir,signals,filesize):
+    print("processing values for tag %s" % tagname)
+    if(signals is None):
+        raise KeyError("tag %s is not in the map file" % tagname)
+    start=time.time()
+    rows,files,written=processtag("%s%s%s" % (indir,os.sep,f),outdir,fileprefix,signals,filesize)
+    return {'tag':tagname,'rows':rows,'files':files,'bytes':written,'seconds':time.time()-start}
+
+# runs processfile in a worker process collecting its log so it is printed in one piece
+def processfilelogged(f,tagname,fileprefix,indir,outdir,signals,filesize):
+    log=io.StringIO()
+    summary={'tag':tagname,'rows':0,'files':0,'bytes':0,'seconds':0,'error':None}
+    with contextlib.redirect_stdout(log):
+        try:
+            summary=processfile(f,tagname,fileprefix,indir,outdir,signals,filesize)
+        except Exception:
+            print("Error processing file %s%s%s" % (indir,os.sep,f))
+            traceback.print_exc(file=log)
+            summary['error']=str(sys.exc_info()[1])
+    return summary,log.getvalue()
+
+# summaries are of tags, or of shards (rows are lines then and have no seconds)
+def printsummary(summaries,elapsed,label="Tag"):
+    width=max([len(label)]+[len(s['tag']) for s in summaries])
+    print("%-*s %12s %8s %14s %10s" % (width,label,"Rows","Files","Bytes","Seconds"))
+    for s in sorted(summaries,key=lambda s:s['tag']):
+        if(s.get('error')):
+            print("%-*s %12s %8s %14s %10s" % (width,s['tag'],"-","-","-","FAILED"))
+        else:
+            print("%-*s %12s %8s %14s %10s" % (width,s['tag'],s['rows'],s['files'],s['bytes'],
+                  "-" if s['seconds'] is None else "%.1f" % s['seconds']))
+    mb=sum(s['bytes'] for s in summaries)/1024/1024
+    print("%s %ss, %s rows, %.1f MB written in %.1f s (%.1f MB/s)" % (len(summaries),label.lower(),
+          sum(s['rows'] for s in summaries),mb,elapsed,mb/max(elapsed,0.001)))
+
 def main():
     # process args
-    indir,outdir,mapfile,filesize=processargs()
+    indir,outdir,mapfile,filesize,workers,shardby,openfiles=processargs()
 
     # Handle output directory
     outdir=handleoutputdir(outdir,indir)
@@ -122,60 +427,29 @@ def main():
     # get maps to signals and tags
     tags=getmappings(mapfile)
 
-    # process files in indir
-    for f in os.listdir(indir):
-        if(f.lower().endswith(".csv")):
-            start=f.rfind(os.sep)
-            end=f.lower().index(".csv")
-            # get tagname
-            tagname=f[(start+1):end]
-            fileprefix=re.sub('\W+','_',tagname)
-            print("processing values for tag %s" % tagname)
-
+    # process files in indir, largest first so the run does not end waiting on a big one
+    tagfiles=tagprefixes([f for f in os.listdir(indir) if f.lower().endswith(".csv")])
+    tagfiles.sort(key=lambda t:os.path.getsize("%s%s%s" % (indir,os.sep,t[0])),reverse=True)
+    start=time.time()
+    summaries=[]
+    if(shardby!="tag"):
+        # shards take lines from many tags, the tags are read one after the other in name order
+        tagfiles.sort(key=lambda t:t[0])
+        summaries=processsharded(tagfiles,indir,outdir,tags,filesize,shardby,openfiles)
+    elif(workers<=1):
+        for f,tagname,fileprefix in tagfiles:
             # get entities and signals to write out
-            signals=tags[tagname]
-
-            with open("%s%s%s" % (indir,os.sep,f)) as fin:
-                reader=csv.reader(fin)
-                # initialize file indexing
-                fn = 0
-                fout=None
-                sizeBytes = 0
-                fpath=None
-                try:
-                    for line in reader:
-                        timestamp=line[0]
-                        value=line[1]
-                        # for each signal
-                        for signal,entities in signals.items():
-                            # if no file open, do it
-                            if (not fout or fout.closed):
-                                # open file
-                                fpath="%s%s%s_%s.csv" % (outdir, os.sep, fileprefix, fn)
-                                fout = open(fpath, 'wb')
-                                # write header
-                                strout = "timestamp,value,signal,entity%s" % os.linesep
-#                                strout = "timestamp,value,señal,entity%s" % os.linesep
-                                btout = strout.encode('UTF-8')
-                                fout.write(btout)
-                                sizeBytes=len(btout)
-                            # write line for each entity
-                            for entity in entities:
-                                strout="%s,%s,%s,%s%s" % (timestamp,value,signal,entity,os.linesep)
-                                btout= strout.encode('UTF-8')
-                                fout.write(btout)
-                                sizeBytes += len(btout)
-                            if(sizeBytes>=filesize*1024*1024):
-                                fn+=1
-                                fout.close()
-                except IOError:
-                    print("IO Error when writing to file %s" % fpath)
-                finally:
-                    # close last file for that tag
-                    if(fout and not fout.closed):
-                        fout.close()
+            summaries.append(processfile(f,tagname,fileprefix,indir,outdir,tags.get(tagname),filesize))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures=[pool.submit(processfilelogged,f,tagname,fileprefix,indir,outdir,tags.get(tagname),filesize)
+                     for f,tagname,fileprefix in tagfiles]
+            for future in concurrent.futures.as_completed(futures):
+                summary,log=future.result()
+                print(log,end='',flush=True)
+                summaries.append(summary)
+    printsummary(summaries,time.time()-start,"Tag" if shardby=="tag" else "Shard")
 
 if __name__ == "__main__":
     main()
 
-
@@ -0,0 +1,84 @@
+import sys
+import os
+import subprocess
+import json
+
+# modules the tools only load on the code paths that need them
+lazymodules=['matplotlib','iso8601','openpyxl','xlrd']
+
+def usage():
+    print("Usage: python StartupCheck.py [-h] [-m module] [-b budgetSec] [-r repeats]")
+    print("where:")
+    print("\t-h - OPTIONAL displays these instructions.")
+    print("\tmodule - OPTIONAL module (script name without .py) to import. Default='TimeseriesGapFiller'.")
+    print("\tbudgetSec - OPTIONAL maximum seconds the import may take. Default=1.0")
+    print("\trepeats - OPTIONAL number of fresh interpreters to time, the fastest is used. Default=3")
+    print("Program imports the module in a fresh interpreter and fails (exit code 1) when the import takes")
+    print("longer than the budget or loads any of %s." % ", ".join(lazymodules))
+    sys.exit(1)
+
+def processargs():
+    module="TimeseriesGapFiller"
+    budget=1.0
+    repeats=3
+    # Arg processing
+    if(len(sys.argv)>1 and "-h" in map(lambda a:a.lower(),sys.argv)):
+        usage()
+    for i in range(1, len(sys.argv), 2):
+        arg = sys.argv[i].lower()
+        if(i>=len(sys.argv)-1):
+            print("Missing value for argument %s" % arg)
+            usage()
+        val = sys.argv[i + 1]
+        if arg == "-m":
+            module = val
+        elif arg == "-b":
+            try:
+                budget=float(val)
+                if(budget<=0):
+                    raise ValueError("Budget must be positive and greater than zero")
+            except ValueError:
+                print("Invalid budget %s" % val)
+                usage()
+        elif arg == "-r":
+            try:
+                repeats=int(val)
+                if(repeats<=0):
+                    raise ValueError("Repeats must be positive and greater than zero")
+            except ValueError:
+                print("Invalid repeats %s" % val)
+                usage()
+        else:
+            print("Unknown argument %s" % arg)
+    return module,budget,repeats
+
+# seconds taken to import module in a fresh interpreter and the lazy modules it loaded
+def timeimport(module):
+    code=("import sys,time,json\n"
+          "start=time.perf_counter()\n"
+          "import %s\n"
+          "print(json.dumps([time.perf_counter()-start,[m for m in %r if m in sys.modules]]))") % (module,lazymodules)
+    out=subprocess.run([sys.executable,"-c",code],cwd=os.path.dirname(os.path.abspath(__file__)),
+                       stdout=subprocess.PIPE,check=True).stdout
+    seconds,loaded=json.loads(out.decode('UTF-8').strip().splitlines()[-1])
+    return seconds,loaded
+
+def main():
+    module,budget,repeats=processargs()
+    results=[timeimport(module) for i in range(repeats)]
+    seconds=min(r[0] for r in results)
+    loaded=sorted(set(m for r in results for m in r[1]))
+    print("Import of %s took %.3f s (budget %.3f s)" % (module,seconds,budget))
+    ok=True
+    if(seconds>budget):
+        print("FAILED: import is over budget")
+        ok=False
+    if(loaded):
+        print("FAILED: modules loaded at import time: %s" % ", ".join(loaded))
+        ok=False
+    if(ok):
+        print("OK")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,23 @@
 import sys
 import os
 import pandas as pd
+import numpy as np
 import datetime
-import dateutil
-import matplotlib.pyplot as plt
-import matplotlib.colors as colors
-import matplotlib.cm as cm
-import iso8601
+import io
+import contextlib
+import traceback
+import json
+import time
+import tracemalloc
+import itertools
+import concurrent.futures
+import TimestampParser as tparser
+import GapKernel as gkernel
+import ExcelCache as xlcache
+
+# file extensions of the output formats and of the files read
+outputformats={'csv':'.csv','parquet':'.parquet','feather':'.feather'}
+inputextensions=('.csv','.xlsx','.parquet','.feather')
 
 # Globals to tune
 mult=100
@@ -15,11 +26,11 @@ div=10
 showDist=False
 
 def usage():
-    print("Usage: python TimeseriesGapFiller.py [-h] -i inputDir [-o outDir] [-t timeCol] [-v valCol] [-f timeFormat] [-p] [-g gapns]")
+    print("Usage: python TimeseriesGapFiller.py [-h] -i inputDir [-o outDir] [-t timeCol] [-v valCol] [-f timeFormat] [-p] [-g gapns] [-s gapMethod] [-j workers] [-c chunkRows] [-w outFormat] [-k keyCols] [-d gapScope] [-n plotPoints] [-a] [-r reportFormat] [-x profileFile] [-l] [-e cacheDir] [-z cacheMB]")
     print("where:")
     print("\t-h - OPTIONAL displays these instructions.")
     print("\tinputDir - Path to input directory containing signal files to be processed")
-    print("\t\tInput files must be csv format and include a header row.")
+    print("\t\tInput files must be csv format and include a header row. xlsx, parquet and feather files are also read.")
     print("\toutputDir - OPTIONAL - Path to output directory where to place files with gaps filled.")
     print("\t\tDefault=Output (subdirectory added to input directory")
     print("\ttimeCol - OPTIONAL the name of the column that contains timestamps.  Default='time'.")
@@ -28,13 +39,43 @@ def usage():
     print("\ttimeFormat - the string describing the format of the timestamps. Default='%Y-%m-%d %H:%M:%S'.  Note for iso specify 'ISO'.")
     print("\t\tMust be one of the formats supported by Python's datetime.strptime method.")
     print("\t\tSee  https://docs.python.org/3/library/datetime.html#strftime-and-strptime-behavior")
-    print("\t\t-p - OPTIONAL creates and saves plots.")
+    print("\t\t-p - OPTIONAL creates and saves plots. Plots are drawn in background processes while files are processed.")
+    print("\t\t-n - OPTIONAL maximum points drawn per plot. Series are reduced to the min and max of each time bucket. Default=2000.")
     print("\t\t-m - OPTIONAL max expected gap.  If gap exceeds this value, it will not be filled.")
     print("\t\t-g - OPTIONAL gap size to use in nanoseconds.  Skips trying to figure out optimal gap and uses passed value instead.")
+    print("\t\t-s - OPTIONAL method used to figure out optimal gap when -g is not passed. Default='solve'.")
+    print("\t\t\t'solve' - bisection on the sorted time deltas.")
+    print("\t\t\t'search' - original incremental search (slow on large files).")
+    print("\t\t\t'both' - runs both, reports the difference and uses 'solve'.")
+    print("\t\t-j - OPTIONAL number of worker processes used to process files in parallel. Default=1.")
+    print("\t\t\tEach file's log is printed once the file is done and a summary is printed at the end.")
+    print("\t\t-c - OPTIONAL streams csv files in chunks of this many rows so memory does not grow with file size.")
+    print("\t\t\tInput must already be sorted by time. Rows out of order across chunks are dropped.")
+    print("\t\t\tUnless -g is passed the gap is figured out from a first pass over the file. Plots are not created.")
+    print("\t\t-w - OPTIONAL format of the output files: 'csv', 'parquet' or 'feather'. Default='csv'.")
+    print("\t\t\tparquet and feather keep the typed time column and require pyarrow.")
+    print("\t\t-k - OPTIONAL comma separated columns identifying each series of a narrow file, e.g. entity,signal.")
+    print("\t\t\tGaps are filled for each group in one pass and the output stays narrow.")
+    print("\t\t-d - OPTIONAL with -k, 'group' figures out a gap for each group, 'shared' one gap for all. Default='group'.")
+    print("\t\t-a - OPTIONAL incremental mode for csv files that grow by appending rows.")
+    print("\t\t\tThe last row, gap and file offset processed are saved in <name>_state.json in the output directory.")
+    print("\t\t\tLater runs only read the new rows, fill gaps from the saved row on and append to the existing outputs.")
+    print("\t\t\tOutputs are not deleted and the gap of the first run is kept. Requires csv output.")
+    print("\t\t-r - OPTIONAL saves the wall time, cpu time, peak memory and rows of each stage of each file")
+    print("\t\t\tto TimeseriesGapFiller_report.json or .csv in the output directory: 'json' or 'csv'.")
+    print("\t\t\tMemory is traced while a stage runs, which slows the run down.")
+    print("\t\t-x - OPTIONAL name of an input file to run under cProfile. Stats are saved to <name>.prof in the output directory.")
+    print("\t\t-l - OPTIONAL low memory mode for files loaded whole. Rows are cleansed in place and no copy of the input is kept.")
+    print("\t\t\tValues are stored as float32 when every value reads back the same, text columns with few distinct values")
+    print("\t\t\tas categories. Interpolated values are then float32 too. The peak memory of each file is added to the summary.")
+    print("\t\t-e - OPTIONAL directory where parsed xlsx files are cached so later runs do not parse them again.")
+    print("\t\t\tEntries are keyed by path, size, modification time and content. 'none' turns the cache off.")
+    print("\t\t\tDefault=%s" % xlcache.defaultdir)
+    print("\t\t-z - OPTIONAL size cap of the xlsx cache in MB, least recently used entries are removed. Default=%s." % xlcache.defaultcapmb)
     print("Program creates files with the original signal file's rows")
     print("plus additional rows with time and values (interpolated) to fill gaps that prevent Falkonry from evaluating assessments.")
     print("Currently only numeric values are supported.  Hence any non-numeric values will be skipped.")
-    print("The output files will be the same as the input names plus '_filled'.")
+    print("The output files will be the same as the input names plus '_filled' (extension of the output format).")
     print("\tExample: input FILEX.csv will result in output FILEX_filled.csv.")
     sys.exit(1)
 
@@ -47,13 +88,28 @@ def processargs():
     plot=False
     gapsize=0
     gaplimit=0
+    gapmethod="solve"
+    workers=1
+    chunksize=0
+    outformat="csv"
+    keycols=[]
+    gapscope="group"
+    plotpoints=2000
+    append=False
+    report=None
+    profile=None
+    lowmem=False
+    cachedir=xlcache.defaultdir
+    cachemb=xlcache.defaultcapmb
     # Arg processing
     if((len(sys.argv)>1 and "-h" in map(lambda a:a.lower(),sys.argv)) or len(sys.argv)<3 ):
         usage()
-    for i in range(1, len(sys.argv), 2):
+    i=1
+    while(i<len(sys.argv)):
         arg = sys.argv[i].lower()
         if(i<len(sys.argv)-1):
             val = sys.argv[i + 1]
+        i+=2
         if arg == "-i":
             indir = val
         elif arg == "-o":
@@ -85,6 +141,75 @@ def processargs():
                 usage()
         elif arg =="-p":
             plot=True
+            i-=1 # takes no value
+        elif arg =="-a":
+            append=True
+            i-=1 # takes no value
+        elif arg =="-l":
+            lowmem=True
+            i-=1 # takes no value
+        elif arg=="-n":
+            try:
+                plotpoints=int(val)
+                if(plotpoints<2):
+                    raise ValueError("Plot points must be at least 2")
+            except ValueError as ve:
+                print("Invalid number of plot points")
+                print(sys.exc_info()[1])
+                usage()
+        elif arg=="-s":
+            gapmethod=val.lower()
+            if(gapmethod not in ("solve","search","both")):
+                print("Invalid gap method %s" % val)
+                usage()
+        elif arg=="-j":
+            try:
+                workers=int(val)
+                if(workers<=0):
+                    raise ValueError("Number of workers must be positive and greater than zero")
+            except ValueError as ve:
+                print("Invalid number of workers")
+                print(sys.exc_info()[1])
+                usage()
+        elif arg=="-c":
+            try:
+                chunksize=int(val)
+                if(chunksize<=1):
+                    raise ValueError("Chunk rows must be greater than one")
+            except ValueError as ve:
+                print("Invalid number of rows per chunk")
+                print(sys.exc_info()[1])
+                usage()
+        elif arg=="-w":
+            outformat=val.lower()
+            if(outformat not in outputformats):
+                print("Invalid output format %s" % val)
+                usage()
+        elif arg=="-k":
+            keycols=[col.strip() for col in val.split(",") if col.strip()]
+        elif arg=="-d":
+            gapscope=val.lower()
+            if(gapscope not in ("group","shared")):
+                print("Invalid gap scope %s" % val)
+                usage()
+        elif arg=="-r":
+            report=val.lower()
+            if(report not in ("json","csv")):
+                print("Invalid report format %s" % val)
+                usage()
+        elif arg=="-x":
+            profile=val
+        elif arg=="-e":
+            cachedir=None if val.lower()=="none" else val
+        elif arg=="-z":
+            try:
+                cachemb=int(val)
+                if(cachemb<=0):
+                    raise ValueError("Cache size must be positive and greater than zero")
+            except ValueError as ve:
+                print("Invalid cache size in MB")
+                print(sys.exc_info()[1])
+                usage()
         else:
             print("Unknown argument %s" % arg)
 
@@ -95,6 +220,21 @@ def processargs():
         print("Input directory %s is not valid" % indir)
         sys.exit(1)
 
+    if(keycols and chunksize>0):
+        print("Grouped files (-k) can not be streamed (-c)")
+        sys.exit(1)
+    if(append and (keycols or outformat!="csv")):
+        print("Incremental mode (-a) requires csv output and can not be used with grouped files (-k)")
+        sys.exit(1)
+
+    # check columnar formats can be written
+    if(outformat!="csv"):
+        try:
+            import pyarrow
+        except ImportError:
+            print("Output format %s requires pyarrow (pip install pyarrow)" % outformat)
+            sys.exit(1)
+
     # check tformat
     if (tformat.lower() != 'iso'):
         try:
@@ -103,19 +243,30 @@ def processargs():
             print("'%s' is not valid timestamp format." % tformat)
             sys.exit(1)
 
-    return indir,outdir,tcol,vcol,tformat,plot,gapsize,gaplimit
+    opts={'tcol':tcol,'vcol':vcol,'tformat':tformat,'plot':plot,'gapsize':gapsize,'gaplimit':gaplimit,
+          'gapmethod':gapmethod,'workers':workers,'chunksize':chunksize,
+          'outformat':outformat,'keycols':keycols,'gapscope':gapscope,
+          'plotpoints':plotpoints,'append':append,'report':report,'profile':profile,'lowmem':lowmem,
+          'xlsxcache':(cachedir,cachemb) if cachedir else None}
+    return indir,outdir,opts
 
-def handleoutputdir(outdir,indir):
+def handleoutputdir(outdir,indir,append=False):
     if(not outdir):
         outdir=os.path.join(indir,"Output")
     if(not os.path.exists(outdir)):
         os.mkdir(outdir)
+    # Outputs of previous runs are appended to
+    if(append):
+        return outdir
     # Empty sub directory
     for f in os.listdir(outdir):
-        if(f.lower().endswith(".csv")):
+        if(f.lower().endswith(tuple(outputformats.values()))):
             os.remove("%s%s%s" % (outdir,os.sep,f))
         if (f.lower().endswith(".pdf")):
             os.remove("%s%s%s" % (outdir, os.sep, f))
+        # state of -a runs, it no longer matches the outputs removed
+        if(f.endswith("_state.json")):
+            os.remove("%s%s%s" % (outdir,os.sep,f))
     return outdir
 
 # GLOBALS FOR MATPLOTLIB
@@ -129,16 +280,17 @@ wspace = 0.2  # the amount of width reserved for space between subplots,
 hspace = 0.5  # the amount of height reserved for space between subplots,
 # expressed as a fraction of the average axis height
 
-# set for different colors using tab20 map
-colorMap = plt.get_cmap('tab20')
-scalarMap = cm.ScalarMappable(norm=colors.Normalize(1, 20), cmap=colorMap)
-
-# format for date time
-from pandas.plotting import register_matplotlib_converters
-register_matplotlib_converters()
+# matplotlib is only loaded when plotting so runs without -p (and -h) start fast
+def importplotting():
+    import matplotlib.pyplot as plt
+    # format for date time
+    from pandas.plotting import register_matplotlib_converters
+    register_matplotlib_converters()
+    return plt
 
 # Borrowed from another project - make no sense anymore
 def plotAndSave(df1,df2,tcol,vcol,f,outdir):
+    plt=importplotting()
     # Make index out of time
     df1=df1.set_index(tcol)
     df2=df2.set_index(tcol)
@@ -174,7 +326,27 @@ def plotAndSave(df1,df2,tcol,vcol,f,outdir):
     plt.close(fig)
     fig.clear()
 
+# positions of the points kept when drawing values v at sorted int64 ns times t with at most maxpoints points
+# keeps the min and max of each of maxpoints/2 equal time buckets (about one per pixel column)
+# so spikes and gaps look the same as in the full series
+def decimate(t,v,maxpoints):
+    if(t.shape[0]<=maxpoints):
+        return np.arange(t.shape[0])
+    buckets=maxpoints//2
+    bucket=((t-t[0]).astype(float)*buckets/(t[-1]-t[0]+1)).astype(np.int64)
+    order=np.lexsort((v,bucket))
+    b=bucket[order]
+    first=np.flatnonzero(np.concatenate([[True],b[1:]!=b[:-1]]))
+    last=np.concatenate([first[1:]-1,[b.shape[0]-1]])
+    return np.unique(np.concatenate([order[first],order[last]]))
+
+# time and value columns of df reduced to at most maxpoints rows for plotting
+def plotframe(df,tcol,vcol,maxpoints):
+    keep=decimate(tons(df[tcol]),df[vcol].to_numpy(dtype=float),maxpoints)
+    return df[[tcol,vcol]].iloc[keep]
+
 def showHist(series,title,bins,xlabel,ylabel="Count"):
+    plt=importplotting()
     # df_to_use['dt'].apply(lambda d:d.total_seconds()).hist(label="Before filling gaps")
     fig, ax = plt.subplots()
 
@@ -187,43 +359,19 @@ def showHist(series,title,bins,xlabel,ylabel="Count"):
     fig.tight_layout()
     plt.show()
 
-# get stats in a series of time deltas
-# calculates gap size (gap)
+# get stats of int64 ns time deltas
+# calculates gap size (gap), all values in ns
 def getgapstats(dt):
-    med = dt.median()
-    gap = mult * med / div
-    gaps=dt.loc[lambda dt: dt >= gap]
-    mx=gaps.max()
-    mi=gaps.min()
-    mn=gaps.mean()
-    cnt=gaps.shape[0]
-    sm=gaps.sum()
+    med=gkernel.median(dt)
+    if(med==gkernel.nat):
+        return gkernel.nat,med,gkernel.nat,gkernel.nat,gkernel.nat,0,0
+    gap=mult*med//div
+    cnt,sm,mi,mx,mn=gkernel.gapstats(dt,gap)
     return gap,med,mx,mi,mn,cnt,sm
 
-# fill gaps in the series passed
-def replacegaps(dt, gap):
-    gaps,newgaps=getgapstofill(dt,gap)
-    newdeltas = dt.drop(gaps.index)
-    newdeltas = newdeltas.append(newgaps)
-    return newdeltas
-
-# returns gap locations and number of intervals to fill
-def getgapstofill(dt,gap):
-    gaps=dt.loc[lambda dt: dt >= gap]
-    # return new gaps
-    intervals = pd.Series()
-    for g in gaps:
-        fullintervals=pd.Series(int(g/gap)*[gap])
-        intervals=intervals.append(fullintervals)
-        # fraction of a gap
-        intervals=intervals.append(pd.Series([g-fullintervals.sum()]))
-    return gaps,intervals
-
 maxsearch=5000
-def calculategapdelta(df):
-    # get series of deltas
-    deltas=df['dt']
-
+# original incremental search on int64 ns time deltas
+def calculategapdelta(deltas):
     # get median and gap count
     gap, med, mx, mn, me, cnt, sm = getgapstats(deltas)
     if(cnt==0):
@@ -234,18 +382,18 @@ def calculategapdelta(df):
     initmed=med
     prevmed=med
     # search at rate proportional to ...
-    delta_mean=deltas.describe()['mean']
-    dt_large=max(med,delta_mean)/div
-    dt_small=min(med,delta_mean)/div
+    delta_mean=int(deltas.mean())
+    dt_large=max(max(med,delta_mean)//div,1)
+    dt_small=max(min(med,delta_mean)//div,1)
     dt=dt_large
-    print("Initial median to fill gaps=%s" % med)
-    gaps,intervals = getgapstofill(deltas, gap)
-    print("%s gaps ranging from %s to %s" % (gaps.shape[0],gaps.min(),gaps.max()))
-    print("Points required to fill gaps=%s" % intervals.shape[0])
+    print("Initial median to fill gaps=%s" % pd.Timedelta(med,'ns'))
+    cnt,sm,mi,mx,mn=gkernel.gapstats(deltas,gap)
+    print("%s gaps ranging from %s to %s" % (cnt,pd.Timedelta(mi,'ns'),pd.Timedelta(mx,'ns')))
+    print("Points required to fill gaps=%s" % gkernel.fillintervals(deltas,gap))
     found=False
     for i in range(maxsearch):
         # fill gaps
-        newdeltas = replacegaps(deltas, gap)
+        newdeltas = gkernel.filldeltas(deltas, gap)
         # get new stats
         stats = getgapstats(newdeltas)
         reqmed=stats[1]
@@ -254,7 +402,7 @@ def calculategapdelta(df):
         # if require is same as prev this is the only solution
         if(reqmed==prevmed):
             print("No need to search after iteration %s" % i)
-            print("Maximum median to fill gaps=%s" % prevmed)
+            print("Maximum median to fill gaps=%s" % pd.Timedelta(prevmed,'ns'))
             found=True
             break
         # there are many values that results in count of 0
@@ -263,133 +411,951 @@ def calculategapdelta(df):
         if(cnt>0 and prevcount==0):
             print("Boundary Crossed at iteration %s" % i)
             if(abs(prevmed-med)<=dt_small):
-                print("Maximum median to fill gaps=%s" % prevmed)
+                print("Maximum median to fill gaps=%s" % pd.Timedelta(prevmed,'ns'))
                 found=True
                 break
             else:
                 print("Backing up and switching to smaller step")
             med=prevmed
-            dt=dt/3  # this needs to be tuned
+            dt=dt//3  # this needs to be tuned
             dt=dt if dt>dt_small else dt_small
             cnt=0
         prevcount=cnt
         prevmed=med
         # increase gap and try again
         med += dt
-        gap = mult * med / div
+        gap = mult * med // div
     if(not found):
         print("Max iteration=%s exceeded" % maxsearch)
-        print("Using median to fill gaps=%s" % initmed)
-    gap= mult * prevmed / div
-    gaps,intervals = getgapstofill(deltas, gap)
-    print("%s gaps ranging from %s to %s" % (gaps.shape[0],gaps.min(),gaps.max()))
-    print("Points required to fill gaps=%s" % intervals.shape[0])
-    return gap
+        print("Using median to fill gaps=%s" % pd.Timedelta(initmed,'ns'))
+    gap= mult * prevmed // div
+    cnt,sm,mi,mx,mn=gkernel.gapstats(deltas,gap)
+    print("%s gaps ranging from %s to %s" % (cnt,pd.Timedelta(mi,'ns'),pd.Timedelta(mx,'ns')))
+    print("Points required to fill gaps=%s" % gkernel.fillintervals(deltas,gap))
+    return pd.Timedelta(gap,'ns')
 
-def main():
-    # process args
-    indir,outdir,tcol,vcol,tformat,plot,gapsize,gaplimit=processargs()
+# median of sorted values repeated counts times (mean of middle values like pandas)
+def weightedmedian(values,counts):
+    cum=np.cumsum(counts)
+    n=cum[-1]
+    lo=values[np.searchsorted(cum,(n-1)//2,side='right')]
+    hi=values[np.searchsorted(cum,n//2,side='right')]
+    return (lo+hi)/2.0
 
-    # Handle output directory
-    outdir=handleoutputdir(outdir,indir)
+# fills gaps for median med on sorted unique deltas (int64 ns) with counts
+# returns new median, deltas left >= new required gap, gaps filled and points required to fill them
+def filledstats(values,counts,med):
+    gap=mult*med//div
+    # deltas are sorted so gaps are the tail
+    i=np.searchsorted(values,gap)
+    full=values[i:]//gap
+    rem=values[i:]-full*gap
+    nfull=int((full*counts[i:]).sum())
+    newvalues=np.concatenate([values[:i],rem,[gap]])
+    newcounts=np.concatenate([counts[:i],counts[i:],[nfull]])
+    order=np.argsort(newvalues,kind='stable')
+    newvalues=newvalues[order]
+    newcounts=newcounts[order]
+    newmed=weightedmedian(newvalues,newcounts)
+    left=int(newcounts[newvalues>=mult*newmed/div].sum())
+    return newmed,left,int(counts[i:].sum()),nfull+int(counts[i:].sum())
 
-    # process files in input directory
-    for f in os.listdir(indir):
-        if(f.lower().endswith(".csv") or f.lower().endswith(".xlsx")):
-            print("Processing file %s%s%s" % (indir,os.sep,f))
-            df=pd.DataFrame()
-            if(f.lower().endswith(".csv")):
-                df=pd.read_csv("%s%s%s" % (indir,os.sep,f))
-                # Convert time column to a datetime
-                if(tformat.lower()=='iso'):
-                    df[tcol]=df[tcol].apply(lambda c:iso8601.parse_date(c))
+# merges two sets of sorted unique deltas and counts
+def mergedeltacounts(values,counts,newvalues,newcounts):
+    merged,inverse=np.unique(np.concatenate([values,newvalues]),return_inverse=True)
+    return merged,np.bincount(inverse,weights=np.concatenate([counts,newcounts]),minlength=merged.shape[0]).astype(np.int64)
+
+def solvegapdelta(deltas):
+    values,counts=np.unique(deltas,return_counts=True)
+    return solvegap(values,counts)
+
+# finds the largest median that leaves no gaps once gaps are filled
+# bisection over integer ns medians, each step evaluated on sorted unique deltas (int64 ns) and counts
+# verbose=False keeps it quiet when solving for many groups
+def solvegap(values,counts,verbose=True):
+    log=print if verbose else lambda *args:None
+    if(values.shape[0]==0):
+        log("Nothing to do")
+        log("Returning gap=%s" % pd.Timedelta.min)
+        return pd.Timedelta.min
+    med=int(weightedmedian(values,counts))
+    gap=mult*med//div
+    if(counts[values>=gap].sum()==0):
+        log("Nothing to do")
+        log("Returning gap=%s" % pd.Timedelta.min)
+        return pd.Timedelta.min
+    log("Initial median to fill gaps=%s" % pd.Timedelta(med,'ns'))
+    log("%s gaps ranging from %s to %s" % (counts[values>=gap].sum(),pd.Timedelta(values[values>=gap][0],'ns'),pd.Timedelta(values[-1],'ns')))
+    log("Points required to fill gaps=%s" % filledstats(values,counts,med)[3])
+    lo=med
+    if(filledstats(values,counts,lo)[1]>0):
+        log("Filling with initial median leaves gaps")
+        log("Using median to fill gaps=%s" % pd.Timedelta(lo,'ns'))
+        return pd.Timedelta(gap,'ns')
+    # nothing is filled once gap exceeds the largest delta, so the original gaps are left
+    hi=int(values[-1])*div//mult+1
+    while(filledstats(values,counts,hi)[1]==0):
+        lo=hi
+        hi*=2
+    steps=0
+    while(hi-lo>1):
+        mid=(lo+hi)//2
+        if(filledstats(values,counts,mid)[1]==0):
+            lo=mid
+        else:
+            hi=mid
+        steps+=1
+    log("Boundary found after %s steps" % steps)
+    log("Maximum median to fill gaps=%s" % pd.Timedelta(lo,'ns'))
+    newmed,left,cnt,points=filledstats(values,counts,lo)
+    gap=mult*lo//div
+    log("%s gaps ranging from %s to %s" % (cnt,pd.Timedelta(values[values>=gap][0],'ns'),pd.Timedelta(values[-1],'ns')))
+    log("Points required to fill gaps=%s" % points)
+    return pd.Timedelta(gap,'ns')
+
+# interpolated values for a value column of dtype: kept float32 in low memory mode,
+# float64 otherwise so integer columns are upcast rather than truncated
+def fillvalues(newv,dtype):
+    if(np.issubdtype(dtype,np.floating)):
+        return newv.astype(dtype,copy=False)
+    return newv
+
+# int64 nanoseconds (UTC when time zone aware) for a datetime series
+def tons(series):
+    if(series.dtype==object):
+        series=pd.to_datetime(series,utc=True)
+    return series.values.astype('datetime64[ns]',copy=False).view('int64')
+
+# datetime values for int64 nanoseconds, in the same time zone as series like
+def fromns(ns,like):
+    times=pd.to_datetime(ns)
+    tz=getattr(like.dt,'tz',None)
+    if(tz is not None):
+        times=times.tz_localize('UTC').tz_convert(tz)
+    return times
+
+# timestamps and interpolated values for every gap in one pass
+# t - sorted int64 ns, v - float values, gaps - positions i where the interval t[i] to t[i+1] is filled
+# step - ns between added points, one for all gaps or one per gap
+# returns the position each new point was interpolated from, its time and its value
+def interpolategaps(t,v,gaps,step):
+    step=np.broadcast_to(np.asarray(step,dtype=np.int64),gaps.shape)
+    t0=t[gaps]
+    t1=t[gaps+1]
+    # number of points strictly before next row
+    n=np.maximum((t1-t0-1)//step,0)
+    src=np.repeat(gaps,n)
+    # 1..n within each gap
+    k=np.arange(n.sum(),dtype=np.int64)-np.repeat(np.cumsum(n)-n,n)+1
+    offset=k*np.repeat(step,n)
+    slope=(v[gaps+1]-v[gaps])/(t1-t0)
+    newt=t[src]+offset
+    newv=np.repeat(slope,n)*offset+v[src]
+    return src,newt,newv
+
+# returns df (sorted and unique in tcol) with rows added to fill gaps >= maxgap
+# gaps larger than gaplimit are not filled (0 fills all)
+# columns other than tcol and vcol are carried forward from the row before the gap
+def fillgaps(df,tcol,vcol,maxgap,gaplimit=pd.Timedelta(0)):
+    t=tons(df[tcol])
+    v=df[vcol].to_numpy(dtype=float)
+    gaps=np.flatnonzero(gkernel.gapmask(gkernel.deltas(t),maxgap.value,gaplimit.value))
+    # minus 1 ns to allow for precision
+    src,newt,newv=interpolategaps(t,v,gaps,maxgap.value-1)
+    if(src.shape[0]==0):
+        return df
+    added=df.iloc[src].copy()
+    added[tcol]=fromns(newt,df[tcol])
+    added[vcol]=fillvalues(newv,df[vcol].dtype)
+    # single concatenation and stable merge on time
+    order=np.argsort(np.concatenate([t,newt]),kind='stable')
+    filled=pd.concat([df,added],ignore_index=True)
+    return filled.iloc[order].reset_index(drop=True)
+
+# shrinks df in place for low memory mode
+# vcol becomes float32 when every value reads back the same, text columns with few distinct values categories
+# columns in skip are left as they are
+def compactframe(df,vcol,skip):
+    v=df[vcol].to_numpy(dtype=float)
+    v32=v.astype(np.float32)
+    # checked in blocks so the text of the values is never held at once
+    block=65536
+    if(all(np.array_equal(v32[i:i+block].astype(str).astype(float),v[i:i+block],equal_nan=True) for i in range(0,v.shape[0],block))):
+        df[vcol]=v32
+    for col in df.columns:
+        if(col not in skip and categorycolumn(df[col])):
+            df[col]=df[col].astype('category')
+
+# text column with few distinct values, smaller stored as a category
+def categorycolumn(col):
+    if(isinstance(col.dtype,pd.CategoricalDtype)):
+        return False
+    return (pd.api.types.is_object_dtype(col) or pd.api.types.is_string_dtype(col)) and col.nunique()*2<col.shape[0]
+
+# reads a csv, parquet or feather file for low memory mode
+# each block of lowmemrows rows is cleansed and its text columns made categories before the next is read
+# so the text of the whole file is never held at once, columns in skip are left as they are
+# which columns become categories is decided on the first block
+lowmemrows=100000
+def readcompact(path,tcol,vcol,tformat,skip):
+    chunks=[]
+    categories=None
+    for chunk in iterframes(path,lowmemrows):
+        chunk[tcol]=parsetimes(chunk[tcol],tformat)
+        chunk[vcol]=pd.to_numeric(chunk[vcol],errors='coerce')
+        chunk.dropna(inplace=True)
+        if(categories is None):
+            categories=[col for col in chunk.columns if col not in skip and categorycolumn(chunk[col])]
+        for col in categories:
+            chunk[col]=chunk[col].astype('category')
+        chunks.append(chunk)
+    if(not chunks):
+        return readframe(path)
+    # same categories in every block so they stay categories when joined
+    for col in categories:
+        union=pd.api.types.union_categoricals([chunk[col] for chunk in chunks]).categories
+        for chunk in chunks:
+            chunk[col]=chunk[col].cat.set_categories(union)
+    return pd.concat(chunks,ignore_index=True)
+
+# converts a column of timestamp strings to datetimes (ns resolution)
+def parsetimes(col,tformat):
+    if(pd.api.types.is_datetime64_any_dtype(col)):
+        times=col
+    elif(tformat.lower()=='iso'):
+        times=tparser.parseiso(col)
+    else:
+        times=pd.to_datetime(col,format=tformat)
+    return pd.Series(fromns(tons(times),times),index=col.index,name=col.name)
+
+# path of output file for input f
+def outputpath(outdir,f,suffix,outformat):
+    return "%s%s%s_%s%s" % (outdir,os.sep,f[:f.rfind('.')],suffix,outputformats[outformat])
+
+# reads a csv, xlsx, parquet or feather file
+# xlsxcache - (directory, size cap MB) of the cache of parsed workbooks, None to always parse them
+def readframe(path,xlsxcache=None):
+    lower=path.lower()
+    if(lower.endswith('.parquet')):
+        return pd.read_parquet(path)
+    elif(lower.endswith('.feather')):
+        return pd.read_feather(path)
+    elif(lower.endswith('.xlsx')):
+        if(xlsxcache):
+            return xlcache.readexcel(path,*xlsxcache)
+        return pd.read_excel(path)
+    return pd.read_csv(path)
+
+# writes a frame as csv, parquet or feather
+def writeframe(df,path,outformat):
+    if(outformat=='parquet'):
+        df.to_parquet(path,index=False)
+    elif(outformat=='feather'):
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path,index=False)
+
+# datetime series as text with nanoseconds, the way to_csv writes a column that has fractions of seconds
+# to_csv of each chunk on its own would write whole seconds in some chunks and nanoseconds in others
+def csvtimes(series):
+    tz=series.dt.tz
+    local=series.dt.tz_localize(None) if tz is not None else series
+    text=np.char.replace(np.datetime_as_string(local.to_numpy(dtype='datetime64[ns]'),unit='ns'),'T',' ')
+    text=pd.Series(text,index=series.index,dtype=object)
+    if(tz is not None):
+        z=series.dt.strftime('%z')
+        text=text+z.str[:3]+':'+z.str[3:]
+    return text.where(series.notna())
+
+# appends frames to a csv, parquet or feather (arrow ipc) file
+# a parquet or feather file has one schema: columns other than keep (time and value) are written as strings,
+# as a carried column read in chunks may be numbers in one chunk and text ("Bad Input") in the next
+class FrameWriter:
+
+    # append=True adds csv rows to an existing file
+    def __init__(self,path,outformat,append=False,keep=()):
+        self.path=path
+        self.outformat=outformat
+        self.first=not(append and os.path.exists(path))
+        self.writer=None
+        self.schema=None
+        self.keep=keep
+
+    def write(self,df):
+        if(self.outformat=='csv'):
+            # one time format for every chunk written
+            times=[col for col in df.columns if pd.api.types.is_datetime64_any_dtype(df[col])]
+            if(times):
+                df=df.assign(**{col:csvtimes(df[col]) for col in times})
+            df.to_csv(self.path,index=False,mode='w' if self.first else 'a',header=self.first)
+        else:
+            import pyarrow as pa
+            df=df.astype({col:'string' for col in df.columns if col not in self.keep})
+            table=pa.Table.from_pandas(df,preserve_index=False)
+            if(self.writer is None):
+                # later chunks are cast to the types of the first one
+                self.schema=table.schema
+                if(self.outformat=='parquet'):
+                    import pyarrow.parquet as pq
+                    self.writer=pq.ParquetWriter(self.path,self.schema)
                 else:
-                    df[tcol]=pd.to_datetime(df[tcol],format=tformat)
-            else:
-                df=pd.read_excel("%s%s%s" % (indir,os.sep,f))
-                vcol=[col for col in df.columns if col!=tcol][0] # assumes is first column not timestamp
+                    self.writer=pa.ipc.new_file(self.path,self.schema)
+            try:
+                table=table.cast(self.schema)
+            except (pa.ArrowInvalid,pa.ArrowTypeError,ValueError):
+                raise ValueError("Rows for %s do not fit the column types of the first chunk %s: %s" %
+                                 (self.path,self.schema.types,sys.exc_info()[1]))
+            self.writer.write_table(table)
+        self.first=False
+
+    def close(self):
+        if(self.writer is not None):
+            self.writer.close()
+            self.writer=None
+
+# raw file reading bytes start to end of path
+class RangeReader(io.RawIOBase):
+
+    def __init__(self,path,start,end):
+        self.fin=open(path,'rb')
+        self.fin.seek(start)
+        self.left=end-start
+
+    def readable(self):
+        return True
 
-            # Convert value column to numeric and drop NaN
-            df[vcol]=pd.to_numeric(df[vcol],errors='coerce')
+    def readinto(self,b):
+        data=self.fin.read(min(len(b),self.left))
+        b[:len(data)]=data
+        self.left-=len(data)
+        return len(data)
+
+    def close(self):
+        self.fin.close()
+        super().close()
+
+# offset after the last complete line of path (past start), rows still being written are left out
+def completelinesend(path,start=0):
+    with open(path,'rb') as fin:
+        pos=os.path.getsize(path)
+        while(pos>start):
+            block=min(65536,pos-start)
+            fin.seek(pos-block)
+            i=fin.read(block).rfind(b'\n')
+            if(i>=0):
+                return pos-block+i+1
+            pos-=block
+    return start
+
+# frames of up to chunksize rows from a csv, parquet or feather file
+# for csv only bytes start to end are read, names are the columns when start is past the header
+def iterframes(path,chunksize,start=0,end=None,names=None):
+    lower=path.lower()
+    if(lower.endswith('.parquet')):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    elif(lower.endswith('.feather')):
+        import pyarrow as pa
+        reader=pa.ipc.open_file(pa.memory_map(path))
+        for i in range(reader.num_record_batches):
+            batch=reader.get_batch(i)
+            for start in range(0,batch.num_rows,chunksize):
+                yield batch.slice(start,chunksize).to_pandas()
+    elif(end is not None):
+        with io.BufferedReader(RangeReader(path,start,end)) as fin:
+            for chunk in pd.read_csv(fin,chunksize=chunksize,header=None if names else 'infer',names=names):
+                yield chunk
+    else:
+        for chunk in pd.read_csv(path,chunksize=chunksize):
+            yield chunk
+
+# cleansed chunks of a file sorted by time
+# rows at or before the last time of the previous chunk (or last) are dropped
+def readchunks(path,tcol,vcol,tformat,chunksize,start=0,end=None,names=None,last=None):
+    for chunk in iterframes(path,chunksize,start,end,names):
+        chunk[tcol]=parsetimes(chunk[tcol],tformat)
+        chunk[vcol]=pd.to_numeric(chunk[vcol],errors='coerce')
+        chunk=chunk.dropna()
+        chunk=chunk.sort_values(tcol,kind='stable').drop_duplicates(subset=tcol,keep='first')
+        if(last is not None):
+            late=tons(chunk[tcol])<=last
+            if(late.any()):
+                print("Dropping %s rows at or before %s (input not sorted?)" % (late.sum(),pd.Timestamp(last)))
+                chunk=chunk[~late]
+        if(chunk.shape[0]==0):
+            continue
+        last=tons(chunk[tcol])[-1]
+        yield chunk
+
+# writes cleansed chunks and, unless maxgap is Timedelta.min, the chunks with gaps filled
+# carry is the row before the first chunk (already written), the last row written is returned
+def fillstream(chunks,tcol,vcol,maxgap,gaptoskip,cleansed,filled,summary,timer,carry=None):
+    for chunk in timer.iterate('read',chunks):
+        with timer.stage('write cleansed') as stage:
+            cleansed.write(chunk)
+            stage['rows']=chunk.shape[0]
+        summary['rows']+=chunk.shape[0]
+        if(maxgap>pd.Timedelta.min):
+            with timer.stage('fill') as stage:
+                rows=chunk.shape[0]
+                carried=carry is not None
+                if(carried):
+                    chunk=pd.concat([carry,chunk],ignore_index=True)
+                chunk=fillgaps(chunk,tcol,vcol,maxgap,gaptoskip)
+                summary['gapsleft']+=gkernel.gapcount(gkernel.deltas(tons(chunk[tcol])),maxgap.value,gaptoskip.value)
+                # carried row was already written with the previous chunk
+                if(carried):
+                    chunk=chunk.iloc[1:]
+                summary['added']+=chunk.shape[0]-rows
+                stage['rows']=chunk.shape[0]
+            with timer.stage('write filled') as stage:
+                filled.write(chunk)
+                stage['rows']=chunk.shape[0]
+        carry=chunk.iloc[-1:]
+    cleansed.close()
+    filled.close()
+    return carry
+
+# processfile for files too large to load, reading chunksize rows at a time
+# the last row of each chunk is carried over so gaps spanning chunks are filled
+def processfilestreamed(f,indir,outdir,opts,timer):
+    return streamfile(f,indir,outdir,opts,timer)[0]
+
+# processfilestreamed reading csv files only up to offset end when passed
+# returns the summary, gap used and last row written
+def streamfile(f,indir,outdir,opts,timer,end=None):
+    tcol=opts['tcol']
+    vcol=opts['vcol']
+    path="%s%s%s" % (indir,os.sep,f)
+    summary={'file':f,'rows':0,'added':0,'gapsleft':0}
+    print("Streaming file %s in chunks of %s rows" % (path,opts['chunksize']))
+    chunks=lambda: readchunks(path,tcol,vcol,opts['tformat'],opts['chunksize'],end=end)
+
+    # Get optimal gap delta from the deltas of a first pass, if asked to do so
+    maxgap=pd.Timedelta(opts['gapsize'],'ns')
+    gaptoskip=pd.Timedelta(opts['gaplimit'],'ns')
+    if(opts['gapsize']<=0):
+        with timer.stage('gap delta') as stage:
+            values=np.empty(0,dtype=np.int64)
+            counts=np.empty(0,dtype=np.int64)
+            last=None
+            for chunk in chunks():
+                t=tons(chunk[tcol])
+                if(last is not None):
+                    t=np.concatenate([[last],t])
+                newvalues,newcounts=np.unique(gkernel.deltas(t),return_counts=True)
+                values,counts=mergedeltacounts(values,counts,newvalues,newcounts)
+                last=t[-1]
+            print("%s distinct time deltas in file" % values.shape[0])
+            maxgap=solvegap(values,counts)
+            stage['rows']=int(counts.sum())+1
+    if(maxgap>pd.Timedelta.min):
+        print("Using delta of %s to fill gaps" % maxgap)
+    else:
+        print("No gaps to fill on file %s" % path)
+
+    cleansed=FrameWriter(outputpath(outdir,f,'cleansed',opts['outformat']),opts['outformat'],keep=(tcol,vcol))
+    filled=FrameWriter(outputpath(outdir,f,'filled',opts['outformat']),opts['outformat'],keep=(tcol,vcol))
+    last=fillstream(chunks(),tcol,vcol,maxgap,gaptoskip,cleansed,filled,summary,timer)
+    print("Rows in set before filling gaps=%s" % summary['rows'])
+    if(maxgap>pd.Timedelta.min):
+        print("Row in set after filling gaps=%s" % (summary['rows']+summary['added']))
+        print("Gap used to fill gaps=%s (%s s)" % (maxgap,maxgap.total_seconds()))
+        print("Gaps left=%s" % summary['gapsleft'])
+    return summary,maxgap,last
+
+# state saved by incremental mode for input f
+def statepath(outdir,f):
+    return "%s%s%s_state.json" % (outdir,os.sep,f[:f.rfind('.')])
+
+# row to save in the state file, time as int64 ns
+def rowtostate(row,tcol):
+    values=row.iloc[0].to_dict()
+    for col,val in values.items():
+        values[col]=val.item() if hasattr(val,'item') else val
+    values[tcol]=int(tons(row[tcol])[0])
+    return values
+
+# saved row as a frame with the columns and time zone of chunk
+def rowfromstate(values,chunk,tcol):
+    row=pd.DataFrame([values])[list(chunk.columns)]
+    row[tcol]=fromns(np.array([values[tcol]],dtype=np.int64),chunk[tcol])
+    return row
+
+# processfile for csv files that grow by appending rows
+# only rows after the offset saved by the previous run are read, gaps are filled from the saved
+# last row on with the saved gap and the results appended to the existing outputs
+def processfileincremental(f,indir,outdir,opts,timer):
+    tcol=opts['tcol']
+    vcol=opts['vcol']
+    path="%s%s%s" % (indir,os.sep,f)
+    chunksize=opts['chunksize'] if opts['chunksize']>0 else 100000
+    state=None
+    if(os.path.exists(statepath(outdir,f))):
+        with open(statepath(outdir,f)) as fin:
+            state=json.load(fin)
+        with open(path,'rb') as fin:
+            header=fin.readline().decode('UTF-8').rstrip('\r\n')
+        if(os.path.getsize(path)<state['offset'] or header!=state['header']):
+            print("File %s was replaced, processing it again" % path)
+            state=None
+        elif(state['last'] is None or state['gap'] is None):
+            # no rows or no gap found yet, the gap is found from the whole file
+            print("No gap of %s found yet, processing it whole" % path)
+            state=None
+    if(state is None):
+        end=completelinesend(path)
+        summary,gap,last=streamfile(f,indir,outdir,dict(opts,chunksize=chunksize),timer,end)
+        with open(path,'rb') as fin:
+            header=fin.readline().decode('UTF-8').rstrip('\r\n')
+        # column names always come from the header, the rows after the offset have none
+        state={'header':header,'columns':header.split(','),'offset':end,
+               'gap':gap.value if gap>pd.Timedelta.min else None,'last':None}
+        if(last is not None):
+            state['last']=rowtostate(last,tcol)
+    else:
+        summary={'file':f,'rows':0,'added':0,'gapsleft':0}
+        end=completelinesend(path,state['offset'])
+        print("Reading %s bytes appended to %s since offset %s" % (end-state['offset'],path,state['offset']))
+        maxgap=pd.Timedelta(state['gap'],'ns') if state['gap'] is not None else pd.Timedelta.min
+        gaptoskip=pd.Timedelta(opts['gaplimit'],'ns')
+        last=state['last'][tcol] if state['last'] else None
+        # fillstream times the reading of the chunks and counts their rows, the first one included
+        chunks=readchunks(path,tcol,vcol,opts['tformat'],chunksize,state['offset'],end,state['header'].split(','),last)
+        first=next(chunks,None)
+        if(first is not None):
+            carry=rowfromstate(state['last'],first,tcol) if state['last'] else None
+            cleansed=FrameWriter(outputpath(outdir,f,'cleansed','csv'),'csv',append=True)
+            filled=FrameWriter(outputpath(outdir,f,'filled','csv'),'csv',append=True)
+            carry=fillstream(itertools.chain([first],chunks),tcol,vcol,maxgap,gaptoskip,cleansed,filled,summary,timer,carry)
+            state['last']=rowtostate(carry,tcol)
+        state['offset']=end
+        print("Rows appended=%s, rows added to fill gaps=%s, gaps left=%s" % (summary['rows'],summary['added'],summary['gapsleft']))
+    with open(statepath(outdir,f),'w') as fout:
+        json.dump(state,fout)
+    return summary
+
+# sorted unique deltas and counts of each group
+# deltas are int64 ns, groups the group of each delta
+def groupdeltacounts(deltas,groups,ngroups):
+    order=np.lexsort((deltas,groups))
+    deltas=deltas[order]
+    bounds=np.searchsorted(groups[order],np.arange(ngroups+1))
+    for k in range(ngroups):
+        yield np.unique(deltas[bounds[k]:bounds[k+1]],return_counts=True)
+
+# processfile for narrow files holding many series identified by the key columns
+# each group is filled with its own gap (or one shared by all) in a single pass over the file
+def processfilegrouped(f,indir,outdir,opts,timer):
+    tcol=opts['tcol']
+    vcol=opts['vcol']
+    keys=opts['keycols']
+    gaptoskip=pd.Timedelta(opts['gaplimit'],'ns')
+    summary={'file':f,'rows':0,'added':0,'gapsleft':0}
+    print("Processing file %s%s%s grouped by %s" % (indir,os.sep,f,",".join(keys)))
+    with timer.stage('read') as stage:
+        if(opts['lowmem'] and not f.lower().endswith(".xlsx")):
+            df=readcompact("%s%s%s" % (indir,os.sep,f),tcol,vcol,opts['tformat'],[tcol,vcol]+keys)
+        else:
+            df=readframe("%s%s%s" % (indir,os.sep,f),opts['xlsxcache'])
+        stage['rows']=df.shape[0]
+    with timer.stage('cleanse') as stage:
+        df[tcol]=parsetimes(df[tcol],opts['tformat'])
+        df[vcol]=pd.to_numeric(df[vcol],errors='coerce')
+        df=df.dropna(subset=[tcol,vcol]+keys)
+
+        # Sort by group then time and drop duplicates
+        df=df.sort_values(keys+[tcol],kind='stable').drop_duplicates(subset=keys+[tcol],keep='first')
+        df=df.reset_index(drop=True)
+        if(opts['lowmem']):
+            compactframe(df,vcol,[tcol]+keys)
+        stage['rows']=df.shape[0]
+    with timer.stage('write cleansed') as stage:
+        writeframe(df,outputpath(outdir,f,'cleansed',opts['outformat']),opts['outformat'])
+        stage['rows']=df.shape[0]
+    summary['rows']=df.shape[0]
+    print("Rows in set before filling gaps=%s" % df.shape[0])
+
+    with timer.stage('gap delta') as stage:
+        # groups are contiguous after sorting, deltas only count within a group
+        groups=df.groupby(keys,sort=False).ngroup().to_numpy()
+        ngroups=int(groups.max())+1 if groups.shape[0]>0 else 0
+        t=tons(df[tcol])
+        dt=gkernel.deltas(t)
+        same=groups[1:]==groups[:-1]
+        print("%s groups" % ngroups)
+
+        # gap of each group, 0 where nothing is filled
+        gaps=np.zeros(ngroups,dtype=np.int64)
+        if(opts['gapsize']>0):
+            gaps[:]=opts['gapsize']
+        elif(opts['gapscope']=="shared"):
+            values,counts=np.unique(dt[same],return_counts=True)
+            gap=solvegap(values,counts)
+            gaps[:]=gap.value if gap>pd.Timedelta.min else 0
+        else:
+            for k,(values,counts) in enumerate(groupdeltacounts(dt[same],groups[1:][same],ngroups)):
+                gap=solvegap(values,counts,verbose=False)
+                gaps[k]=gap.value if gap>pd.Timedelta.min else 0
+        stage['rows']=df.shape[0]
+    names=df.groupby(keys,sort=False).size()
+    for k,name in enumerate(names.index):
+        print("%s: rows=%s gap=%s" % (name,names.iloc[k],pd.Timedelta(gaps[k],'ns') if gaps[k]>0 else "none"))
+
+    with timer.stage('fill') as stage:
+        # gaps of every group filled at once
+        rowgap=gaps[groups[:-1]]
+        mask=same & (rowgap>0) & gkernel.gapmask(dt,rowgap,gaptoskip.value)
+        at=np.flatnonzero(mask)
+        # minus 1 ns to allow for precision
+        src,newt,newv=interpolategaps(t,df[vcol].to_numpy(dtype=float),at,rowgap[at]-1)
+        added=df.iloc[src].copy()
+        added[tcol]=fromns(newt,df[tcol])
+        added[vcol]=fillvalues(newv,df[vcol].dtype)
+        order=np.lexsort((np.concatenate([t,newt]),np.concatenate([groups,groups[src]])))
+        filled=pd.concat([df,added],ignore_index=True).iloc[order].reset_index(drop=True)
+        summary['added']=src.shape[0]
+        stage['rows']=filled.shape[0]
+    print("Row in set after filling gaps=%s" % filled.shape[0])
+
+    # check results after filling gaps
+    with timer.stage('check') as stage:
+        groups=np.concatenate([groups,groups[src]])[order]
+        dt=gkernel.deltas(tons(filled[tcol]))
+        rowgap=gaps[groups[:-1]]
+        left=(groups[1:]==groups[:-1]) & (rowgap>0) & gkernel.gapmask(dt,rowgap,gaptoskip.value)
+        summary['gapsleft']=int(left.sum())
+        stage['rows']=filled.shape[0]
+    print("Gaps left=%s" % summary['gapsleft'])
+    with timer.stage('write filled') as stage:
+        writeframe(filled,outputpath(outdir,f,'filled',opts['outformat']),opts['outformat'])
+        stage['rows']=filled.shape[0]
+    if(opts['plot']):
+        print("Plots are not created for grouped files")
+    return summary
+
+# resets the peak resident memory of the process, only possible on linux
+def resetpeakrss():
+    try:
+        with open('/proc/self/clear_refs','w') as refs:
+            refs.write('5')
+    except OSError:
+        pass
+
+# peak resident memory of the process in MB
+# without /proc it is the peak since the process started
+def peakrssmb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if(line.startswith('VmHWM:')):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    import resource
+    peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1048576 if sys.platform=='darwin' else peak/1024
+
+# wall time, cpu time, peak memory and rows of each stage of processing a file
+# stages with the same name are added up, e.g. the chunks of a streamed file
+# memory=True measures the peak resident memory of the whole file between start and stop
+class StageTimer:
+
+    def __init__(self,enabled=False,memory=False):
+        self.enabled=enabled
+        self.memory=memory
+        self.stages={}
+
+    def start(self):
+        if(self.memory):
+            resetpeakrss()
+
+    # returns the peak MB since start (None when not measured)
+    def stop(self):
+        return peakrssmb() if self.memory else None
+
+    # times the block, the block may set 'rows' in the yielded dict
+    # peak memory of a stage is what python and numpy allocated during it (tracemalloc)
+    # a stage inside another one leaves the tracing of the outer stage running and gets its peak so far
+    @contextlib.contextmanager
+    def stage(self,name):
+        if(not self.enabled):
+            yield {}
+            return
+        info={}
+        nested=tracemalloc.is_tracing()
+        if(not nested):
+            tracemalloc.start()
+        wall=time.perf_counter()
+        cpu=time.process_time()
+        try:
+            yield info
+        finally:
+            wall=time.perf_counter()-wall
+            cpu=time.process_time()-cpu
+            peak=tracemalloc.get_traced_memory()[1]/1048576
+            if(not nested):
+                tracemalloc.stop()
+            record=self.stages.setdefault(name,{'stage':name,'wall_s':0.0,'cpu_s':0.0,'peak_mb':0.0,'rows':0,'calls':0})
+            record['wall_s']+=wall
+            record['cpu_s']+=cpu
+            record['peak_mb']=max(record['peak_mb'],peak)
+            record['rows']+=info.get('rows',0)
+            record['calls']+=1
+
+    # yields the frames of chunks timing the reading of each one
+    def iterate(self,name,chunks):
+        chunks=iter(chunks)
+        while(True):
+            with self.stage(name) as info:
+                chunk=next(chunks,None)
+                if(chunk is not None):
+                    info['rows']=chunk.shape[0]
+            if(chunk is None):
+                return
+            yield chunk
+
+    def records(self,f):
+        return [dict({'file':f},**record) for record in self.stages.values()]
+
+# plotAndSave with the time of drawing the plots as a stage record
+def plotAndSaveTimed(report,df1,df2,tcol,vcol,f,outdir):
+    timer=StageTimer(report)
+    with timer.stage('plot') as stage:
+        plotAndSave(df1,df2,tcol,vcol,f,outdir)
+        stage['rows']=df1.shape[0]+df2.shape[0]
+    return timer.records(f)
+
+reportcolumns=['file','stage','wall_s','cpu_s','peak_mb','rows','calls']
+
+# saves the stage records of all files to TimeseriesGapFiller_report.json or .csv in outdir
+def writereport(records,outdir,report):
+    path="%s%sTimeseriesGapFiller_report.%s" % (outdir,os.sep,report)
+    records=sorted(records,key=lambda r:r['file'])
+    if(report=="json"):
+        with open(path,'w') as out:
+            json.dump(records,out,indent=1)
+    else:
+        pd.DataFrame(records,columns=reportcolumns).to_csv(path,index=False)
+    print("Stage report saved to %s" % path)
+    width=max([len("File")]+[len(r['file']) for r in records])
+    print("%-*s %-16s %10s %10s %10s %12s" % (width,"File","Stage","Wall s","CPU s","Peak MB","Rows"))
+    for r in records:
+        print("%-*s %-16s %10.3f %10.3f %10.1f %12s" % (width,r['file'],r['stage'],r['wall_s'],r['cpu_s'],r['peak_mb'],r['rows']))
+
+# cleanse, fill gaps, save and plot file f of indir
+# returns a summary of the rows in, rows added and gaps left
+# with a report the time and memory of each stage are added, with a profile the file is run under cProfile
+# with a report or in low memory mode the peak resident memory of the file is added
+def processfile(f,indir,outdir,opts):
+    timer=StageTimer(opts['report'] is not None,opts['report'] is not None or opts['lowmem'])
+    profiler=None
+    if(opts['profile']==f):
+        import cProfile
+        profiler=cProfile.Profile()
+        profiler.enable()
+    timer.start()
+    try:
+        if(opts['keycols']):
+            summary=processfilegrouped(f,indir,outdir,opts,timer)
+        elif(opts['append'] and f.lower().endswith(".csv")):
+            summary=processfileincremental(f,indir,outdir,opts,timer)
+        elif(opts['chunksize']>0 and not f.lower().endswith(".xlsx")):
+            summary=processfilestreamed(f,indir,outdir,opts,timer)
+        else:
+            summary=processfilewhole(f,indir,outdir,opts,timer)
+    finally:
+        peak=timer.stop()
+        if(profiler):
+            profiler.disable()
+            profiler.dump_stats("%s%s%s.prof" % (outdir,os.sep,f[:f.rfind('.')]))
+            print("Profile saved to %s%s%s.prof" % (outdir,os.sep,f[:f.rfind('.')]))
+    summary['stages']=timer.records(f)
+    if(peak is not None):
+        summary['peakmb']=peak
+        print("Peak memory=%.1f MB" % peak)
+    return summary
+
+# processfile for files loaded whole
+def processfilewhole(f,indir,outdir,opts,timer):
+    tcol=opts['tcol']
+    vcol=opts['vcol']
+    tformat=opts['tformat']
+    gapsize=opts['gapsize']
+    gaplimit=opts['gaplimit']
+    gapmethod=opts['gapmethod']
+    summary={'file':f,'rows':0,'added':0,'gapsleft':0}
+    print("Processing file %s%s%s" % (indir,os.sep,f))
+    with timer.stage('read') as stage:
+        if(opts['lowmem'] and not f.lower().endswith(".xlsx")):
+            df=readcompact("%s%s%s" % (indir,os.sep,f),tcol,vcol,tformat,[tcol,vcol])
+        elif(not f.lower().endswith(".xlsx")):
+            df=readframe("%s%s%s" % (indir,os.sep,f))
+            # Convert time column to a datetime
+            df[tcol]=parsetimes(df[tcol],tformat)
+        else:
+            df=readframe("%s%s%s" % (indir,os.sep,f),opts['xlsxcache'])
+            vcol=[col for col in df.columns if col!=tcol][0] # assumes is first column not timestamp
+        stage['rows']=df.shape[0]
+
+    with timer.stage('cleanse') as stage:
+        # Convert value column to numeric and drop NaN
+        df[vcol]=pd.to_numeric(df[vcol],errors='coerce')
+        if(opts['lowmem']):
+            # cleanse the rows read, no copy is kept
+            df.dropna(inplace=True)
+            df_to_use=df
+        else:
             df_to_use=pd.DataFrame(df.dropna())
+        del df
 
-            # Sort in order of time and drop duplicates
-            df_to_use.sort_values(tcol,inplace=True)
-            df_to_use.drop_duplicates(subset=tcol,keep='first',inplace=True)
-
-            # Save cleansed inputs as CSV
-            df_to_use.to_csv("%s%s%s_cleansed.csv" % (outdir,os.sep,f[:f.rfind('.')]),index=False)
-
-            # get positive time differences to next row (ns resolution)
-            df_to_use['dt']=-1.0*df_to_use[tcol].diff(periods=-1)
-            print("Rows in set before filling gaps=%s" % df_to_use.shape[0])
-
-            # Get optimal gap delta, if asked to do so
-            maxgap=pd.Timedelta(gapsize,'ns')
-            gaptoskip=pd.Timedelta(gaplimit,'ns')
-            if(gapsize<=0):
-                maxgap=calculategapdelta(df_to_use)
-            if(maxgap>pd.Timedelta.min):
-                if(showDist):
-                    showHist(df_to_use['dt'].apply(lambda d:d.total_seconds()),'Before filling gaps',20,'Interval (sec)')
-
-                print("Using delta of %s to fill gaps" % maxgap)
-
-                # get rows and next where dt is >= maxgap
-                # using bitwise operators - https://stackoverflow.com/questions/36921951/truth-value-of-a-series-is-ambiguous-use-a-empty-a-bool-a-item-a-any-o
-                to_interp=df_to_use.loc[lambda df: (df.dt >= maxgap) & ((gaplimit==0) | (df.dt <= gaptoskip))]
-                to_interp_next=df_to_use.loc[lambda df: df.shift(1)[tcol].isin(to_interp[tcol])][[tcol,vcol]]
-
-                # loop through gaps filling them and adding to original df as well
-                nextrows=to_interp_next.iterrows()
-                for index,row in to_interp.iterrows():
-                    nextrow=next(nextrows)[1]
-                    # compute slope and initialize next timestamp
-                    slope=(nextrow[vcol]-row[vcol])/(nextrow[tcol].value-row[tcol].value)
-                    nextts = row[tcol] + maxgap - pd.Timedelta(value=1, units="ns") # minus 1 ns to allow for precision
-                    while(nextts<nextrow[tcol]):
-                        interp_val=slope*(nextts.value-row[tcol].value)+row[vcol]
-                        # create dictionary of entry to add to dataframe
-                        entry={}
-                        for col in df_to_use.columns:
-                            if(col==tcol):
-                                entry[col]=nextts
-                            elif(col==vcol):
-                                entry[col]=interp_val
-                            else:
-                                entry[col]=row[col]
-                        # add new values
-                        df_to_use=df_to_use.append(entry,ignore_index=True)
-                        # update next time
-                        nextts+=maxgap-pd.Timedelta(value=1,units="ns") # minus 1 ns to allow for precision
-
-                print("Row in set after filling gaps=%s" % df_to_use.shape[0])
-
-                # sort in time order
+        # Sort in order of time and drop duplicates
+        df_to_use.sort_values(tcol,inplace=True)
+        df_to_use.drop_duplicates(subset=tcol,keep='first',inplace=True)
+        if(opts['lowmem']):
+            compactframe(df_to_use,vcol,[tcol])
+        stage['rows']=df_to_use.shape[0]
+
+    # Save cleansed inputs
+    with timer.stage('write cleansed') as stage:
+        writeframe(df_to_use,outputpath(outdir,f,'cleansed',opts['outformat']),opts['outformat'])
+        stage['rows']=df_to_use.shape[0]
+    if(opts['plot']):
+        with timer.stage('decimate'):
+            before=plotframe(df_to_use,tcol,vcol,opts['plotpoints'])
+
+    with timer.stage('gap delta') as stage:
+        # get positive time differences to next row (int64 ns)
+        dt=gkernel.deltas(tons(df_to_use[tcol]))
+        print("Rows in set before filling gaps=%s" % df_to_use.shape[0])
+        summary['rows']=df_to_use.shape[0]
+        stage['rows']=df_to_use.shape[0]
+
+        # Get optimal gap delta, if asked to do so
+        maxgap=pd.Timedelta(gapsize,'ns')
+        gaptoskip=pd.Timedelta(gaplimit,'ns')
+        if(gapsize<=0 and gapmethod=="search"):
+            maxgap=calculategapdelta(dt)
+        elif(gapsize<=0):
+            maxgap=solvegapdelta(dt)
+            if(gapmethod=="both"):
+                searched=calculategapdelta(dt)
+                print("Gap solved=%s searched=%s difference=%s" % (maxgap,searched,maxgap-searched))
+    if(maxgap>pd.Timedelta.min):
+        if(showDist):
+            showHist(dt/1e9,'Before filling gaps',20,'Interval (sec)')
+
+        print("Using delta of %s to fill gaps" % maxgap)
+
+        # fill all gaps at once
+        with timer.stage('fill') as stage:
+            df_to_use=fillgaps(df_to_use,tcol,vcol,maxgap,gaptoskip)
+            stage['rows']=df_to_use.shape[0]
+
+        print("Row in set after filling gaps=%s" % df_to_use.shape[0])
+        summary['added']=df_to_use.shape[0]-summary['rows']
+
+        with timer.stage('check') as stage:
+            # sort in time order (fillgaps already returns rows in time order)
+            if(not opts['lowmem']):
                 df_to_use.sort_values(tcol,inplace=True)
 
-                # check results after filling gaps
-                df_to_use['dt']=-1.0*df_to_use[tcol].diff(periods=-1)
-                print("Gap used to fill gaps=%s (%s s)" % (maxgap,maxgap.total_seconds()))
-                print("Gaps left=%s" % df_to_use['dt'].loc[lambda dt: (dt >= maxgap) & ((gaplimit==0) | (dt <= gaptoskip))].shape[0])
-                gap=getgapstats(df_to_use['dt'])[0]
-                print("New gap required to fill gaps=%s" % gap)
-                if(maxgap>gap):
-                    print("Something went wrong with file %s%s%s - required gap is smaller that used gap" % (indir,os.sep,f))
-                    print("Gaps left=%s" % df_to_use['dt'].loc[lambda dt: (dt >= gap) & ((gaplimit==0) | (dt <= gaptoskip))].shape[0])
-
-                if(showDist):
-                    showHist(df_to_use['dt'].apply(lambda d:d.total_seconds()),'After filling gaps',20,'Interval (sec)')
-
-                # Save output file
-                df_to_use[[col for col in df_to_use.columns if col!='dt']].to_csv("%s%s%s_filled.csv" % (outdir,os.sep,f[:f.rfind('.')]),index=False)
-                                                                                  # ,date_format="%Y-%m-%d %H:%M:%S.%f")
-
-                # Plot and save before and after
-                if(plot):
-                    plotAndSave(df,df_to_use,tcol,vcol,f,outdir)
-            else:
-                print("No gaps to fill on file %s%s%s" % (indir,os.sep,f))
+            # check results after filling gaps
+            dt=gkernel.deltas(tons(df_to_use[tcol]))
+            print("Gap used to fill gaps=%s (%s s)" % (maxgap,maxgap.total_seconds()))
+            summary['gapsleft']=gkernel.gapcount(dt,maxgap.value,gaplimit)
+            print("Gaps left=%s" % summary['gapsleft'])
+            gap=getgapstats(dt)[0]
+            print("New gap required to fill gaps=%s" % pd.Timedelta(gap,'ns'))
+            if(maxgap.value>gap):
+                print("Something went wrong with file %s%s%s - required gap is smaller that used gap" % (indir,os.sep,f))
+                print("Gaps left=%s" % gkernel.gapcount(dt,gap,gaplimit))
+            stage['rows']=df_to_use.shape[0]
+
+        if(showDist):
+            showHist(dt/1e9,'After filling gaps',20,'Interval (sec)')
+
+        # Save output file
+        with timer.stage('write filled') as stage:
+            writeframe(df_to_use,outputpath(outdir,f,'filled',opts['outformat']),opts['outformat'])
+            stage['rows']=df_to_use.shape[0]
+
+        # Before and after to be plotted by the caller
+        if(opts['plot']):
+            with timer.stage('decimate'):
+                summary['plot']=(before,plotframe(df_to_use,tcol,vcol,opts['plotpoints']),tcol,vcol,f,outdir)
+    else:
+        print("No gaps to fill on file %s%s%s" % (indir,os.sep,f))
+    return summary
+
+# runs processfile in a worker process collecting its log so it is printed in one piece
+def processfilelogged(f,indir,outdir,opts):
+    log=io.StringIO()
+    summary={'file':f,'rows':0,'added':0,'gapsleft':0,'error':None}
+    with contextlib.redirect_stdout(log):
+        try:
+            summary=processfile(f,indir,outdir,opts)
+        except Exception:
+            print("Error processing file %s%s%s" % (indir,os.sep,f))
+            traceback.print_exc(file=log)
+            summary['error']=str(sys.exc_info()[1])
+    return summary,log.getvalue()
+
+# peak memory is only shown when it was traced
+def printsummary(summaries):
+    width=max([len("File")]+[len(s['file']) for s in summaries])
+    peaks=any('peakmb' in s for s in summaries)
+    print("%-*s %12s %12s %10s%s" % (width,"File","Rows in","Rows added","Gaps left"," %10s" % "Peak MB" if peaks else ""))
+    for s in sorted(summaries,key=lambda s:s['file']):
+        peak=" %10.1f" % s['peakmb'] if 'peakmb' in s else " %10s" % "-" if peaks else ""
+        if(s.get('error')):
+            print("%-*s %12s %12s %10s%s" % (width,s['file'],"-","-","FAILED",peak))
+        else:
+            print("%-*s %12s %12s %10s%s" % (width,s['file'],s['rows'],s['added'],s['gapsleft'],peak))
+
+def main():
+    # process args
+    indir,outdir,opts=processargs()
+
+    # Handle output directory
+    outdir=handleoutputdir(outdir,indir,opts['append'])
+
+    # process files in input directory
+    files=[f for f in os.listdir(indir) if f.lower().endswith(inputextensions)]
+    summaries=[]
+    # plots are drawn in the background while the next files are processed
+    plotpool=None
+    plots=[]
+    if(opts['plot']):
+        plotpool=concurrent.futures.ProcessPoolExecutor(max_workers=opts['workers'])
+    if(opts['workers']<=1):
+        for f in files:
+            summary=processfile(f,indir,outdir,opts)
+            if('plot' in summary):
+                plots.append(plotpool.submit(plotAndSaveTimed,opts['report'] is not None,*summary.pop('plot')))
+            summaries.append(summary)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=opts['workers']) as pool:
+            futures=[pool.submit(processfilelogged,f,indir,outdir,opts) for f in files]
+            for future in concurrent.futures.as_completed(futures):
+                summary,log=future.result()
+                print(log,end='',flush=True)
+                if('plot' in summary):
+                    plots.append(plotpool.submit(plotAndSaveTimed,opts['report'] is not None,*summary.pop('plot')))
+                summaries.append(summary)
+    records=[r for s in summaries for r in s.get('stages',[])]
+    if(plotpool):
+        for future in plots:
+            try:
+                records+=future.result()
+            except Exception:
+                print("Error creating plot")
+                print(sys.exc_info()[1])
+        plotpool.shutdown()
+    printsummary(summaries)
+    if(opts['report']):
+        writereport(records,outdir,opts['report'])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,104 @@
+import re
+import datetime
+import numpy as np
+import pandas as pd
+
+# ISO 8601 variants handled in bulk, e.g. 2019-01-20T00:00:00.123-06:00 or 2019-01-20 00:00:00Z
+isopattern=re.compile(r'^\d{4}-\d{2}-\d{2}(?P<sep>[T ])?(?:\d{2}:\d{2}(?P<sec>:\d{2}(?P<frac>\.\d+)?)?)?(?P<off>Z|[+-]\d{2}:?\d{2})?$')
+offsetpattern=re.compile(r'^(?:Z|(?P<sign>[+-])(?P<hh>\d{2}):?(?P<mm>\d{2}))$')
+# trailing UTC offset
+trailingoffset=r'(?:Z|[+-]\d{2}:?\d{2})$'
+samplesize=100
+nat=np.iinfo(np.int64).min
+
+# strptime format (without offset) and width of the trailing offset of an ISO timestamp string
+# None if not a known variant
+def isoformat(s):
+    m=isopattern.match(s)
+    if(not m):
+        return None
+    fmt="%Y-%m-%d"
+    if(m.group('sep')):
+        fmt+=m.group('sep')+"%H:%M"
+        if(m.group('sec')):
+            fmt+=":%S"
+        if(m.group('frac')):
+            fmt+=".%f"
+    return fmt,len(m.group('off') or '')
+
+# most common ISO variant in the first samplesize values of col
+def detectisoformat(col):
+    variants={}
+    for s in col.dropna().head(samplesize).astype(str):
+        variant=isoformat(s)
+        if(variant):
+            variants[variant]=variants.get(variant,0)+1
+    return max(variants,key=variants.get) if variants else None
+
+# nanoseconds east of UTC for an offset string like -06:00, +0530 or Z (None if not an offset)
+def offsetns(offset):
+    m=offsetpattern.match(offset)
+    if(not m):
+        return None
+    if(offset=='Z'):
+        return 0
+    sign=-1 if m.group('sign')=='-' else 1
+    return sign*(int(m.group('hh'))*3600+int(m.group('mm'))*60)*1000000000
+
+# parses a column of ISO 8601 strings to int64 nanoseconds since epoch (UTC), NaT as int64 min
+# the detected variant (and the same variant with/without fractions) is parsed for the whole column
+# with the offset split off, so strptime never sees %z and each distinct offset is parsed once
+# only rows neither handles go through iso8601 one at a time
+# returns the nanoseconds and the set of offsets seen (None when some rows were not parsed in bulk)
+def parseisoandoffsets(col):
+    ns=np.full(col.shape[0],nat,dtype=np.int64)
+    todo=col.notna().to_numpy().copy()
+    offsets=set()
+    variant=detectisoformat(col)
+    if(variant):
+        fmt,width=variant
+        alt=fmt.replace(".%f","") if ".%f" in fmt else fmt.replace(":%S",":%S.%f")
+        for f in (fmt,alt):
+            if(not todo.any()):
+                break
+            rows=np.flatnonzero(todo)
+            sub=col.iloc[rows].astype(str)
+            if(width>0):
+                local=sub.str.slice(0,-width)
+                offs=sub.str.slice(-width)
+                parsedoffsets={o:offsetns(o) for o in offs.unique()}
+                shift=offs.map(parsedoffsets).to_numpy(dtype=float)
+            else:
+                local=sub
+                shift=np.zeros(rows.shape[0])
+            parsed=pd.to_datetime(local,format=f,errors='coerce')
+            valid=parsed.notna().to_numpy() & ~np.isnan(shift)
+            localns=parsed.values.astype('datetime64[ns]').view('int64')
+            ns[rows[valid]]=localns[valid]-shift[valid].astype(np.int64)
+            todo[rows[valid]]=False
+            if(width>0):
+                offsets.update(offs[valid].unique())
+            elif(valid.any()):
+                offsets.add('Z')
+    if(todo.any()):
+        import iso8601
+        rows=np.flatnonzero(todo)
+        slow=pd.to_datetime(col.iloc[rows].apply(lambda c:iso8601.parse_date(c)),utc=True)
+        ns[rows]=slow.values.astype('datetime64[ns]').view('int64')
+        offsets=None
+    return ns,offsets
+
+# parses a column of ISO 8601 strings to datetimes
+# timestamps are kept in their UTC offset when every row has the same one, otherwise they are in UTC
+def parseiso(col):
+    ns,offsets=parseisoandoffsets(col)
+    times=pd.Series(pd.to_datetime(ns).tz_localize('UTC'),index=col.index)
+    if(offsets and len(offsets)==1):
+        shift=offsetns(offsets.pop())
+        if(shift!=0):
+            times=times.dt.tz_convert(datetime.timezone(datetime.timedelta(microseconds=shift//1000)))
+    return times
+
+# removes the UTC offset from a column of ISO 8601 strings leaving local time
+def stripoffsets(col):
+    return col.str.replace(trailingoffset,'',regex=True)